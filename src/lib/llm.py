@@ -1,16 +1,23 @@
+import asyncio
+import contextvars
+import copy
+import hashlib
 import html
 import json
+import math
+import os
 import random
 import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, wraps
 
-import requests
 from aws import async_invoke
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
-from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.pydantic_v1 import BaseModel, Field
-from typing import List, Optional
 from sw.core import (
     broadcast_to_user,
     get_campaign,
@@ -22,6 +29,12 @@ from sw.core import (
 from sw.errors import catch_errors
 from sw.sourcewhale import content_suggestions
 
+try:
+    from sw.sourcewhale import content_suggestions_batch
+except ImportError:
+    # older sw layers can only score one step per request
+    content_suggestions_batch = None
+
 VALID_CUSTOM_VARS = [
     "{{firstName}}",
     "{[senderFirstName]}",
@@ -37,84 +50,1069 @@ VALID_CUSTOM_VARS = [
     "{[senderCalendarLink]}",
 ]
 
-# Pydantic models for structured output
-class CampaignTemplate(BaseModel):
-    subject: Optional[str] = Field(description="Email subject line (optional for some mail types)")
-    body: str = Field(description="Email body content with line breaks as \\n")
-    mailType: str = Field(description="Type of outreach: email, phoneCall, linkedinConnectionRequest, inmail, sms")
+VALID_CUSTOM_VAR_SET = frozenset(VALID_CUSTOM_VARS)
+
+CUSTOM_VAR_PATTERN = re.compile(r"(\{{2}\w+\}{2}|\{\[\w+\]\})")
+# "hope", "trust" and "well" phrases; word boundaries so "dwell" is fine
+SPAM_PATTERN = re.compile(
+    r"\b(hope|hoped|hopes|hoping|hopefully|trust|well)\b", re.IGNORECASE
+)
+# [placeholder] text that is not part of a {[customVar]}
+PLACEHOLDER_PATTERN = re.compile(r"(?<!\{)\[[^\[\]]*\](?!\})")
+SEARCH_TERM_PATTERN = re.compile(r"[a-z0-9]+")
+CAMPAIGN_TITLE_PATTERN = re.compile(r'"title"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+# upper bound on concurrent content_suggestions calls per campaign
+VALIDATION_MAX_WORKERS = 8
+
+# how long a content_suggestions result is reused for an unchanged step
+SCORE_CACHE_TTL = 3600
+
+# candidates requested in parallel per regenerate click. Opt-in: each one is
+# a full-prompt call, while the default serial path (1) stops at the first
+# usable candidate and can be served from response_cache
+REGENERATE_CANDIDATES = int(os.environ.get("LLM_REGENERATE_CANDIDATES", "1"))
+
+# concurrent generations for chatbot_bulk_response; rate limits are handled
+# by RateLimitedLLM
+BULK_MAX_CONCURRENCY = 4
+
+# bounds on the re-score/repair loop in process_content_validation
+REPAIR_MAX_ROUNDS = 2
+REPAIR_TOKEN_BUDGET = 12000
+
+# failed steps sent to the model per modification request
+MODIFICATION_BATCH_SIZE = 8
+
+# cap on the replicateTone sample inlined into the campaign prompt
+TONE_SAMPLE_MAX_TOKENS = 600
+
+# run chatbot_response on the asyncio pipeline (ainvoke + overlapped I/O)
+ASYNC_PIPELINE = os.environ.get("LLM_ASYNC_PIPELINE") == "1"
+
+# model and parameter profile per task. Modification and regeneration only
+# make small, constrained rewrites so they start on the fast model; their
+# "Escalated" routes are used when the output still scores below threshold
+CAMPAIGN_MODEL = os.environ.get("LLM_CAMPAIGN_MODEL", "gpt-4o")
+FAST_MODEL = os.environ.get("LLM_FAST_MODEL", "gpt-4o-mini")
+MODEL_ROUTES = {
+    "campaign": {"model": CAMPAIGN_MODEL, "temperature": 1, "max_tokens": 4095},
+    "modification": {"model": FAST_MODEL, "temperature": 1, "max_tokens": 4095},
+    "modificationEscalated": {"model": CAMPAIGN_MODEL, "temperature": 1, "max_tokens": 4095},
+    "regeneration": {"model": FAST_MODEL, "temperature": 1, "max_tokens": 1024},
+    "regenerationEscalated": {"model": CAMPAIGN_MODEL, "temperature": 1, "max_tokens": 1024},
+}
+
+# USD per million input, cached input and output tokens
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+
+# totalScore below which a step is repaired (and a fast-model result escalated)
+QUALITY_THRESHOLD = 70
+
+# "invoke" hands every request to its own self-invocation, "queue" puts it
+# on job_queue for run_worker (or an SQS event source) to drain in batches
+DISPATCH_MODE = os.environ.get("LLM_DISPATCH", "invoke")
+QUEUE_BATCH_SIZE = 10
+QUEUE_MAX_CONCURRENCY = 10
+QUEUE_POLL_SECONDS = 20
+QUEUE_VISIBILITY_TIMEOUT = 300
+QUEUE_MAX_ATTEMPTS = 3
+
+# retried invocations and double clicks reuse the first campaign generated
+# for a messageId and payload instead of paying for it again
+IDEMPOTENCY_TTL = int(os.environ.get("LLM_IDEMPOTENCY_TTL", "3600"))
+# in-flight claims expire so a crashed or timed out invocation can be retried
+IDEMPOTENCY_LOCK_TTL = 900
+IDEMPOTENCY_WAIT_SECONDS = 300
+# duplicates poll the in-flight claim with backoff up to the max interval
+IDEMPOTENCY_POLL_SECONDS = 0.05
+IDEMPOTENCY_POLL_MAX_SECONDS = 1
+
+# expected output tokens per template (JSON included), used to size
+# max_tokens from the planned step sequence instead of always asking for 4095
+STEP_OUTPUT_TOKENS = {
+    "email": 260,
+    "inmail": 200,
+    "linkedinConnectionRequest": 100,
+    "sms": 90,
+    "phoneCall": 40,
+}
+CAMPAIGN_TITLE_TOKENS = 40
+OUTPUT_BUDGET_MARGIN = 1.25
+OUTPUT_BUDGET_MIN = 256
+# follow-up requests for the rest of a campaign cut off at max_tokens
+CONTINUATION_MAX_ROUNDS = 3
+
+# past campaigns of the same team that passed validation are retrieved as
+# extra few-shot examples, up to this many and within the token budget
+FEW_SHOT_EXAMPLES = int(os.environ.get("LLM_FEW_SHOT_EXAMPLES", "2"))
+FEW_SHOT_TOKEN_BUDGET = 3000
+
+# LangChain components are created on first use (see init_langchain) so the
+# synchronous front door of lambda_handler never pays for importing them
+llm = None
+route_llms = {}
+modification_parser = None
+regeneration_parser = None
+campaign_parser = None
+SystemMessage = HumanMessage = AIMessage = None
+langchain_lock = threading.Lock()
+
+
+def init_langchain():
+    global llm, route_llms, modification_parser, regeneration_parser, campaign_parser
+    global SystemMessage, HumanMessage, AIMessage
+
+    if llm is not None:
+        return
+
+    with langchain_lock:
+        if llm is not None:
+            return
+
+        from typing import List, Optional
+
+        from langchain_core import messages
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_core.pydantic_v1 import BaseModel, Field
+        from langchain_openai import ChatOpenAI
+
+        # Pydantic models for structured output
+        class CampaignTemplate(BaseModel):
+            subject: Optional[str] = Field(description="Email subject line (optional for some mail types)")
+            body: str = Field(description="Email body content with line breaks as \\n")
+            mailType: str = Field(description="Type of outreach: email, phoneCall, linkedinConnectionRequest, inmail, sms")
+
+        class CampaignOutput(BaseModel):
+            title: str = Field(description="Campaign title")
+            templates: List[CampaignTemplate] = Field(description="List of campaign templates")
+
+        class RegeneratedTemplate(BaseModel):
+            subject: str = Field(description="Updated subject line")
+            body: str = Field(description="Updated body content")
+
+        class RegeneratedOutput(BaseModel):
+            templates: RegeneratedTemplate = Field(description="Single regenerated template")
+
+        class ModificationOutput(BaseModel):
+            templates: List[RegeneratedTemplate] = Field(description="List of modified templates")
+
+        SystemMessage = messages.SystemMessage
+        HumanMessage = messages.HumanMessage
+        AIMessage = messages.AIMessage
+
+        modification_parser = JsonOutputParser(pydantic_object=ModificationOutput)
+        regeneration_parser = JsonOutputParser(pydantic_object=RegeneratedOutput)
+        campaign_parser = JsonOutputParser(pydantic_object=CampaignOutput)
+
+        # provider limits are per model, so routes on the same model share buckets
+        buckets = {}
+        clients = {}
+        for route, profile in MODEL_ROUTES.items():
+            if profile["model"] not in buckets:
+                buckets[profile["model"]] = (
+                    TokenBucket(int(os.environ.get("LLM_RPM_LIMIT", "500"))),
+                    TokenBucket(int(os.environ.get("LLM_TPM_LIMIT", "300000"))),
+                )
+            clients[route] = RateLimitedLLM(
+                ChatOpenAI(
+                    **profile,
+                    timeout=45,
+                    # retries are handled by RateLimitedLLM
+                    max_retries=0,
+                ),
+                route=route,
+                buckets=buckets[profile["model"]],
+            )
+
+        # assigned last so other threads only see a fully initialised module
+        route_llms = clients
+        llm = clients["campaign"]
+
+
+def route_llm(route, escalated=False):
+    """The client for a task type, or its stronger escalation route."""
+    init_langchain()
+    if escalated and route + "Escalated" in route_llms:
+        route += "Escalated"
+    return route_llms[route]
+
+
+class NullTraceSink:
+    def emit(self, record):
+        pass
+
+
+class PrintTraceSink:
+    def emit(self, record):
+        print(json.dumps(record, default=str))
+
+
+class InvocationTrace:
+    """Per-stage timings and counters for one invocation, emitted as one record."""
+
+    def __init__(self, entryPoint):
+        self.entryPoint = entryPoint
+        self.started = time.perf_counter()
+        self.stages = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, **fields):
+        record = {"stage": name, **fields}
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["ms"] = round((time.perf_counter() - started) * 1000, 1)
+            with self.lock:
+                self.stages.append(record)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_record(self):
+        return {
+            "entryPoint": self.entryPoint,
+            "ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "stages": self.stages,
+            "counters": self.counters,
+        }
+
+
+trace_sink = PrintTraceSink() if os.environ.get("LLM_TRACE") == "print" else NullTraceSink()
+# per invocation, so concurrent invocations in one process get their own
+# trace; asyncio.to_thread and TracedThreadPoolExecutor carry it into workers
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def set_trace_sink(sink):
+    global trace_sink
+    trace_sink = sink
+
+
+def traced(entryPoint):
+    """Trace an entry point; nested entry points share the outer trace."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_trace.get() is not None:
+                return func(*args, **kwargs)
+
+            trace = InvocationTrace(entryPoint)
+            token = current_trace.set(trace)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                current_trace.reset(token)
+                trace_sink.emit(trace.to_record())
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def trace_stage(name, **fields):
+    trace = current_trace.get()
+    if trace is None:
+        yield {}
+        return
+    with trace.stage(name, **fields) as record:
+        yield record
+
+
+def trace_increment(name, amount=1):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.increment(name, amount)
+
+
+class TracedThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor whose tasks run in the submitter's context, so
+    their stages and counters land on the submitting invocation's trace."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def is_rate_limit_error(error):
+    return (
+        type(error).__name__ == "RateLimitError"
+        or getattr(error, "status_code", None) == 429
+    )
+
+
+def is_retryable_error(error):
+    status = getattr(error, "status_code", None)
+    return (
+        is_rate_limit_error(error)
+        or (status is not None and status >= 500)
+        or type(error).__name__ in ("APITimeoutError", "APIConnectionError", "TimeoutError")
+    )
+
+
+def retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DuplicateInFlightError(Exception):
+    """A duplicate request gave up waiting on an in-flight claim; raised so
+    the invocation or queued job is retried once the claim has expired."""
+
+
+class TokenBucket:
+    def __init__(self, perMinute):
+        self.capacity = perMinute
+        self.tokens = perMinute
+        self.rate = perMinute / 60
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimitedLLM:
+    """Wraps the ChatOpenAI client with request/token buckets, jittered
+    exponential backoff that honours retry-after, and a circuit breaker.
+
+    While the circuit is open calls raise CircuitOpenError immediately so
+    callers drop to their existing fallbacks instead of piling on retries.
+    Latency, tokens and cost of every call are recorded under `route`.
+    """
+
+    def __init__(self, client, route, buckets, maxRetries=2, failureThreshold=5, cooldown=30):
+        self.client = client
+        self.route = route
+        # (requests, tokens) buckets, shared by every route on the same model
+        self.requests, self.tokens = buckets
+        self.maxRetries = maxRetries
+        self.failureThreshold = failureThreshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.openUntil = 0
+        self.pausedUntil = 0
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # model_name, temperature, max_tokens, ...
+        return getattr(self.client, name)
+
+    def estimate_tokens(self, messages, maxTokens=None):
+        # the provider counts max_tokens against the per-minute token limit
+        prompt = sum(len(message.content) for message in messages) // 4
+        return prompt + (maxTokens or getattr(self.client, "max_tokens", None) or 0)
+
+    def before_call(self, messages, maxTokens=None):
+        if time.monotonic() < self.openUntil:
+            trace_increment("circuitOpen")
+            raise CircuitOpenError("LLM circuit breaker is open")
+
+        pause = self.pausedUntil - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+
+        self.requests.acquire()
+        self.tokens.acquire(self.estimate_tokens(messages, maxTokens))
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self, error):
+        # only provider-side trouble trips the breaker; a bad request
+        # (400, parse error, ...) says nothing about the model's health
+        if not is_retryable_error(error):
+            return
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failureThreshold:
+                print(f"LLM circuit breaker open for {self.cooldown}s after {self.failures} failures.")
+                self.openUntil = time.monotonic() + self.cooldown
+                self.failures = 0
+
+    def backoff(self, error, attempt):
+        delay = retry_after_seconds(error)
+        if delay is None:
+            delay = min(20, 2**attempt) * random.uniform(0.5, 1)
+        if is_rate_limit_error(error):
+            trace_increment("rateLimited")
+            # hold back every caller, not just this one
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + delay)
+        return delay
+
+    def record_metrics(self, started, response):
+        stats = route_metrics.setdefault(
+            self.route,
+            {"model": self.client.model_name, "calls": 0, "seconds": 0.0, "inputTokens": 0, "outputTokens": 0, "cost": 0.0},
+        )
+        usage = usage_tokens(response)
+        cost = 0.0
+        if usage:
+            inputTokens, cachedTokens, outputTokens = usage
+            inputPrice, cachedPrice, outputPrice = MODEL_PRICES.get(self.client.model_name, (0, 0, 0))
+            cost = (
+                (inputTokens - cachedTokens) * inputPrice
+                + cachedTokens * cachedPrice
+                + outputTokens * outputPrice
+            ) / 1_000_000
+
+        with self.lock:
+            stats["calls"] += 1
+            stats["seconds"] += time.perf_counter() - started
+            if usage:
+                stats["inputTokens"] += inputTokens
+                stats["outputTokens"] += outputTokens
+            stats["cost"] += cost
+        trace_increment("llmCost", cost)
+
+    def invoke(self, messages, **kwargs):
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            self.before_call(messages, kwargs.get("max_tokens"))
+            try:
+                response = self.client.invoke(messages, **kwargs)
+            except Exception as e:
+                if not is_retryable_error(e) or attempt >= self.maxRetries:
+                    self.record_failure(e)
+                    raise
+                delay = self.backoff(e, attempt)
+                attempt += 1
+                print(f"LLM call failed ({e}). Retrying in {delay:.1f}s...")
+                time.sleep(delay)
+                continue
+
+            self.record_success()
+            self.record_metrics(started, response)
+            return response
+
+    async def ainvoke(self, messages, **kwargs):
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            await asyncio.to_thread(self.before_call, messages, kwargs.get("max_tokens"))
+            try:
+                response = await self.client.ainvoke(messages, **kwargs)
+            except Exception as e:
+                if not is_retryable_error(e) or attempt >= self.maxRetries:
+                    self.record_failure(e)
+                    raise
+                delay = self.backoff(e, attempt)
+                attempt += 1
+                print(f"LLM call failed ({e}). Retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+                continue
+
+            self.record_success()
+            self.record_metrics(started, response)
+            return response
+
+    def stream(self, messages, **kwargs):
+        started = time.perf_counter()
+        completion = None
+        # no retries once tokens have been handed to the caller
+        self.before_call(messages, kwargs.get("max_tokens"))
+        try:
+            for chunk in self.client.stream(messages, **kwargs):
+                completion = chunk if completion is None else completion + chunk
+                yield chunk
+        except Exception as e:
+            self.record_failure(e)
+            raise
+        self.record_success()
+        self.record_metrics(started, completion)
+
+
+class MemoryCacheBackend:
+    """In-process LRU store; survives across warm Lambda invocations."""
+
+    def __init__(self, maxEntries=256):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
 
-class CampaignOutput(BaseModel):
-    title: str = Field(description="Campaign title")
-    templates: List[CampaignTemplate] = Field(description="List of campaign templates")
+    def set(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
 
-class RegeneratedTemplate(BaseModel):
-    subject: str = Field(description="Updated subject line")
-    body: str = Field(description="Updated body content")
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
 
-class RegeneratedOutput(BaseModel):
-    templates: RegeneratedTemplate = Field(description="Single regenerated template")
 
-class ModificationOutput(BaseModel):
-    templates: List[RegeneratedTemplate] = Field(description="List of modified templates")
+class FileCacheBackend:
+    """One JSON file per key; stands in locally for a shared DynamoDB table."""
 
-# Initialize LangChain components
-llm = ChatOpenAI(
-    model="gpt-4o",
-    temperature=1,
-    max_tokens=4095,
-    timeout=45
+    def __init__(self, directory, maxEntries=1024):
+        self.directory = directory
+        self.maxEntries = maxEntries
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, entry):
+        with open(self.path(key), "w") as f:
+            json.dump(entry, f)
+
+        files = [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".json")
+        ]
+        if len(files) > self.maxEntries:
+            files.sort(key=os.path.getmtime)
+            for path in files[: len(files) - self.maxEntries]:
+                os.remove(path)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+
+class ResponseCache:
+    """Content-addressed cache in front of llm.invoke.
+
+    Each key holds up to `candidates` completions. With rotate=True the cache
+    keeps calling the model until the pool is full and then cycles through
+    it, so repeated regenerate clicks still get a different result.
+    """
+
+    def __init__(self, backend, ttl=3600, candidates=3):
+        self.backend = backend
+        self.ttl = ttl
+        self.candidates = candidates
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, messages, client):
+        payload = {
+            "messages": [[message.type, message.content] for message in messages],
+            "model": getattr(client, "model_name", None),
+            "temperature": getattr(client, "temperature", None),
+            "max_tokens": getattr(client, "max_tokens", None),
+        }
+        return hashlib.sha256(
+            json.dumps(payload, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def lookup(self, key):
+        entry = self.backend.get(key)
+        if entry is None or entry["expires"] < time.time() or not entry["candidates"]:
+            return None
+        return entry
+
+    def invoke(self, messages, rotate=False, client=None):
+        client = client or llm
+        key = self.key(messages, client)
+        entry = self.lookup(key)
+
+        if entry and (not rotate or len(entry["candidates"]) >= self.candidates):
+            self.hits += 1
+            trace_increment("responseCacheHits")
+            content = entry["candidates"][entry["next"] % len(entry["candidates"])]
+            if rotate:
+                entry["next"] += 1
+                self.backend.set(key, entry)
+            return AIMessage(content=content)
+
+        self.misses += 1
+        trace_increment("responseCacheMisses")
+        with trace_stage("llm"):
+            response = client.invoke(messages)
+
+        entry = entry or {"candidates": [], "next": 0}
+        entry["candidates"].append(response.content)
+        entry["candidates"] = entry["candidates"][-self.candidates :]
+        entry["expires"] = time.time() + self.ttl
+        self.backend.set(key, entry)
+
+        return response
+
+    def discard(self, messages, content, client=None):
+        """Drop a candidate that failed to parse or validate."""
+        key = self.key(messages, client or llm)
+        entry = self.backend.get(key)
+        if entry is None or content not in entry["candidates"]:
+            return
+
+        entry["candidates"].remove(content)
+        if entry["candidates"]:
+            self.backend.set(key, entry)
+        else:
+            self.backend.delete(key)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def create_cache_backend():
+    backend = os.environ.get("LLM_CACHE_BACKEND", "memory")
+    if backend == "file":
+        return FileCacheBackend(os.environ.get("LLM_CACHE_DIR", "/tmp/llm-cache"))
+    return MemoryCacheBackend()
+
+
+response_cache = ResponseCache(
+    create_cache_backend(), ttl=int(os.environ.get("LLM_CACHE_TTL", "3600"))
 )
 
-modification_parser = JsonOutputParser(pydantic_object=ModificationOutput)
-regeneration_parser = JsonOutputParser(pydantic_object=RegeneratedOutput)
-campaign_parser = JsonOutputParser(pydantic_object=CampaignOutput)
 
-def validate_content(step, stepIndex, teamId):
-    def text_to_html(text):
-        return re.sub(
-            r"(\{{2}\w+\}{2}|\{\[\w+\]\})",
-            r'<span class="custom-var">\1</span>',
-            html.escape(text).replace("\n", "<br>"),
+class MemoryIdempotencyBackend:
+    """Local idempotency records; only deduplicates within one process."""
+
+    def __init__(self, maxEntries=1024):
+        self.maxEntries = maxEntries
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+
+    def claim(self, key, lockTtl):
+        """Atomically claim `key` unless it is in flight or done.
+        Returns ("claimed", None), ("inFlight", None) or ("done", result)."""
+        with self.lock:
+            record = self.records.get(key)
+            if record is not None and record["expires"] >= time.time():
+                return record["state"], record.get("result")
+
+            self.records[key] = {"state": "inFlight", "expires": time.time() + lockTtl}
+            self.records.move_to_end(key)
+            while len(self.records) > self.maxEntries:
+                self.records.popitem(last=False)
+            return "claimed", None
+
+    def complete(self, key, result, ttl):
+        with self.lock:
+            self.records[key] = {"state": "done", "result": result, "expires": time.time() + ttl}
+
+    def release(self, key):
+        with self.lock:
+            self.records.pop(key, None)
+
+
+class DynamoDBIdempotencyBackend:
+    """Idempotency records in a DynamoDB table keyed by "key", with the
+    table's TTL set to the "expires" attribute."""
+
+    def __init__(self, tableName):
+        self.tableName = tableName
+        self.table = None
+
+    def dynamodb(self):
+        if self.table is None:
+            import boto3
+
+            self.table = boto3.resource("dynamodb").Table(self.tableName)
+        return self.table
+
+    def claim(self, key, lockTtl):
+        table = self.dynamodb()
+        now = time.time()
+        try:
+            table.put_item(
+                Item={"key": key, "state": "inFlight", "expires": int(now + lockTtl)},
+                # DynamoDB TTL deletes lazily, so expired records count as absent
+                ConditionExpression="attribute_not_exists(#key) OR #expires < :now",
+                ExpressionAttributeNames={"#key": "key", "#expires": "expires"},
+                ExpressionAttributeValues={":now": int(now)},
+            )
+            return "claimed", None
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            record = table.get_item(Key={"key": key}, ConsistentRead=True).get("Item")
+
+        if record is None:
+            # released between the put and the get
+            return self.claim(key, lockTtl)
+        result = json.loads(record["result"]) if "result" in record else None
+        return record["state"], result
+
+    def complete(self, key, result, ttl):
+        self.dynamodb().put_item(
+            Item={
+                "key": key,
+                "state": "done",
+                "result": json.dumps(result),
+                "expires": int(time.time() + ttl),
+            }
         )
 
-    stepSubject = step.get("subject", "")
-    stepBody = step.get("body", "")
-    mailType = step.get("mailType", "")
+    def release(self, key):
+        self.dynamodb().delete_item(Key={"key": key})
+
+
+def create_idempotency_backend():
+    backend = os.environ.get("LLM_IDEMPOTENCY_BACKEND", "memory")
+    if backend == "dynamodb":
+        return DynamoDBIdempotencyBackend(os.environ["LLM_IDEMPOTENCY_TABLE"])
+    return MemoryIdempotencyBackend()
+
+
+idempotency_store = create_idempotency_backend()
+
+
+def search_terms(text):
+    return SEARCH_TERM_PATTERN.findall(text.lower())
+
+
+class CampaignExampleIndex:
+    """In-memory BM25 index of past campaigns that passed validation.
+
+    Examples are grouped (team, outreach type, prompt variant) so a request
+    only ever sees campaigns its own team generated. With `path` the index
+    is loaded from and appended to a JSON lines file. The file is read on
+    first use rather than at import, keeping it off the front door's cold
+    start, and is rewritten once it holds twice maxEntries examples.
+    """
+
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self, path=None, maxEntries=2000):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.groups = {}
+        self.order = []
+        self.documentFrequency = Counter()
+        self.totalLength = 0
+        self.lock = threading.Lock()
+        self.loaded = path is None
+        self.fileEntries = 0
+
+    def load(self):
+        """Index the newest maxEntries examples in `path`; lock held."""
+        self.loaded = True
+        if not os.path.exists(self.path):
+            return
+        total = 0
+        lines = deque(maxlen=self.maxEntries)
+        with open(self.path) as f:
+            for line in f:
+                lines.append(line)
+                total += 1
+        for line in lines:
+            self.insert(json.loads(line))
+        self.fileEntries = total
+        if total > len(lines):
+            self.compact()
+
+    def compact(self):
+        """Rewrite `path` with only the indexed examples; lock held."""
+        fields = ("group", "text", "userPrompt", "assistant")
+        temporaryPath = f"{self.path}.tmp"
+        with open(temporaryPath, "w") as f:
+            for example in self.order:
+                f.write(json.dumps({field: example[field] for field in fields}) + "\n")
+        os.replace(temporaryPath, self.path)
+        self.fileEntries = len(self.order)
+
+    def insert(self, example):
+        example["terms"] = Counter(search_terms(example["text"]))
+        example["length"] = sum(example["terms"].values())
+
+        self.groups.setdefault(example["group"], []).append(example)
+        self.order.append(example)
+        self.documentFrequency.update(example["terms"].keys())
+        self.totalLength += example["length"]
+
+        while len(self.order) > self.maxEntries:
+            oldest = self.order.pop(0)
+            self.groups[oldest["group"]].remove(oldest)
+            self.documentFrequency.subtract(oldest["terms"].keys())
+            self.totalLength -= oldest["length"]
+
+    def add(self, group, text, userPrompt, assistant):
+        example = {"group": group, "text": text, "userPrompt": userPrompt, "assistant": assistant}
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(example) + "\n")
+                self.fileEntries += 1
+            self.insert(example)
+            if self.fileEntries > 2 * self.maxEntries:
+                self.compact()
+
+    def search(self, group, text, limit, tokenBudget):
+        """Up to `limit` best-matching examples whose prompt and completion
+        fit in `tokenBudget` tokens together."""
+        query = set(search_terms(text))
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            candidates = list(self.groups.get(group, ()))
+            if not candidates or not query:
+                return []
+            count = len(self.order)
+            averageLength = self.totalLength / count
+            scored = []
+            for example in candidates:
+                terms = example["terms"]
+                score = 0.0
+                for term in query & terms.keys():
+                    frequency = self.documentFrequency[term]
+                    idf = math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+                    tf = terms[term]
+                    score += idf * tf * (self.k1 + 1) / (
+                        tf + self.k1 * (1 - self.b + self.b * example["length"] / averageLength)
+                    )
+                if score > 0:
+                    scored.append((score, example))
+
+        scored.sort(key=lambda pair: pair[0], reverse=True)
+        examples = []
+        for _, example in scored:
+            if len(examples) >= limit:
+                break
+            tokens = (len(example["userPrompt"]) + len(example["assistant"])) // 4
+            if tokens <= tokenBudget:
+                examples.append(example)
+                tokenBudget -= tokens
+        return examples
+
+
+example_index = CampaignExampleIndex(os.environ.get("LLM_EXAMPLE_INDEX_PATH"))
+
+
+# input/cached token totals per route, to track provider prompt-cache savings
+prompt_cache_stats = {}
+
+
+def response_token_count(response):
+    usage = getattr(response, "usage_metadata", None) or {}
+    if "total_tokens" in usage:
+        return usage["total_tokens"]
+    tokenUsage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+    return tokenUsage.get("total_tokens", 0)
+
+
+def usage_tokens(response):
+    """(input, cached input, output) tokens of a response, or None without usage."""
+    usage = getattr(response, "usage_metadata", None) or {}
+    tokenUsage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+
+    inputTokens = usage.get("input_tokens", tokenUsage.get("prompt_tokens"))
+    if inputTokens is None:
+        # cache hits from response_cache carry no usage
+        return None
+
+    outputTokens = usage.get("output_tokens", tokenUsage.get("completion_tokens", 0))
+    cachedTokens = (usage.get("input_token_details") or {}).get("cache_read")
+    if cachedTokens is None:
+        cachedTokens = (tokenUsage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+
+    return inputTokens, cachedTokens or 0, outputTokens or 0
+
+
+# calls, latency, tokens and cost per model route (see RateLimitedLLM)
+route_metrics = {}
+
+
+def record_usage(route, response):
+    """Record token usage on the current trace and per-route prompt-cache stats."""
+    usage = usage_tokens(response)
+    if usage is None:
+        return
+
+    inputTokens, cachedTokens, outputTokens = usage
+    trace_increment("promptTokens", inputTokens)
+    trace_increment("completionTokens", outputTokens)
+    trace_increment("cachedPromptTokens", cachedTokens)
+
+    stats = prompt_cache_stats.setdefault(
+        route, {"calls": 0, "inputTokens": 0, "cachedTokens": 0}
+    )
+    stats["calls"] += 1
+    stats["inputTokens"] += inputTokens
+    stats["cachedTokens"] += cachedTokens
+
+
+# extracted replicateTone samples keyed by campaign id and content hash
+tone_sample_cache = MemoryCacheBackend(maxEntries=128)
+
+
+# shared by every validation so concurrent campaigns pool their scoring calls
+validation_executor = TracedThreadPoolExecutor(max_workers=VALIDATION_MAX_WORKERS)
+
+
+# steps scored on first validation and how many of them fell below threshold
+validation_stats = {"steps": 0, "failed": 0}
+validation_stats_lock = threading.Lock()
+
+
+# content_suggestions results keyed by step content, so re-validating an
+# edited campaign only scores the steps that changed
+score_cache = MemoryCacheBackend(maxEntries=4096)
+
+
+def score_cache_key(step, stepIndex, teamId):
+    payload = [
+        step.get("subject") or "",
+        step.get("body") or "",
+        step.get("mailType") or "",
+        stepIndex > 0,
+        teamId,
+    ]
+    return hashlib.sha256(json.dumps(payload).encode("utf-8")).hexdigest()
+
+
+def cached_score(step, stepIndex, teamId):
+    entry = score_cache.get(score_cache_key(step, stepIndex, teamId))
+    if entry is None or entry["expires"] < time.time():
+        return None
+    return copy.deepcopy(entry["suggestions"])
+
 
-    contentSuggestionsBody = {
-        "content": text_to_html(stepBody),
+def store_score(step, stepIndex, teamId, suggestions):
+    score_cache.set(
+        score_cache_key(step, stepIndex, teamId),
+        {"suggestions": copy.deepcopy(suggestions), "expires": time.time() + SCORE_CACHE_TTL},
+    )
+
+
+def text_to_html(text):
+    return CUSTOM_VAR_PATTERN.sub(
+        r'<span class="custom-var">\1</span>',
+        html.escape(text).replace("\n", "<br>"),
+    )
+
+
+def build_content_suggestions_body(step, stepIndex):
+    return {
+        "content": text_to_html(step.get("body", "")),
         "isFollowUp": stepIndex > 0,
         "isSendAsReply": False,
-        "outreachType": mailType,
-        "subject": text_to_html(stepSubject),
+        "outreachType": step.get("mailType", ""),
+        "subject": text_to_html(step.get("subject") or ""),
     }
 
-    suggestions = content_suggestions(contentSuggestionsBody, teamId)
 
-    # check for invalid custom variables
-    invalidVars = []
-    pattern = r"(\{{2}\w+\}{2}|\{\[\w+\]\})"
-    for text in [stepSubject, stepBody]:
-        matches = re.findall(pattern, text)
-        invalidVars.extend(
-            [match for match in matches if match not in VALID_CUSTOM_VARS]
-        )
+def screen_step(step):
+    """Run the local content checks without calling content_suggestions."""
+    stepSubject = step.get("subject") or ""
+    stepBody = step.get("body") or ""
+
+    invalidVars = {
+        match
+        for text in (stepSubject, stepBody)
+        for match in CUSTOM_VAR_PATTERN.findall(text)
+        if match not in VALID_CUSTOM_VAR_SET
+    }
+
+    return {
+        "invalidCustomVars": sorted(invalidVars),
+        "spamWords": sorted({word.lower() for word in SPAM_PATTERN.findall(stepBody)}),
+        "placeholders": PLACEHOLDER_PATTERN.findall(stepBody),
+    }
+
+
+def screen_failed(screen):
+    return bool(screen["invalidCustomVars"] or screen["spamWords"] or screen["placeholders"])
+
+
+def apply_local_checks(step, suggestions, screen=None):
+    screen = screen or screen_step(step)
+    highlights = suggestions.setdefault("highlights", {})
 
-    if invalidVars:
+    # check for invalid custom variables
+    if screen["invalidCustomVars"]:
         suggestions["totalScore"]["num"] = 0
-        suggestions["invalidCustomVars"] = list(set(invalidVars))
+        suggestions["invalidCustomVars"] = screen["invalidCustomVars"]
+        highlights["invalidCustomVars"] = screen["invalidCustomVars"]
 
-    # check for spam words
-    if any(
-        word in stepBody.strip().lower() for word in ["hope", "trust", "well"]
-    ) or re.search(r"\[.*?\]", stepBody):
+    # check for spam words and [placeholder] text
+    if screen["spamWords"] or screen["placeholders"]:
         suggestions["totalScore"]["num"] = 0
+        highlights["spamWords"] = sorted(
+            set(highlights.get("spamWords", [])) | set(screen["spamWords"])
+        )
 
     return suggestions
 
 
-def modify_failed_steps(failedSteps):
-    system_prompt = """As a chatbot designed to help users update content, your job is to remove the provided words that are considered spammy, make the content more concise, remove any "hope", "trust", or "well" phrases, remove any invalid custom variables, and replace any text wrapped with [] with {[]} instead, (so that the updated text has both [] and {}), whilst ensuring that the content still reads well.
+def validate_content(step, stepIndex, teamId):
+    contentSuggestionsBody = build_content_suggestions_body(step, stepIndex)
+    with trace_stage("contentSuggestions", stepIndex=stepIndex):
+        suggestions = content_suggestions(contentSuggestionsBody, teamId)
+    return apply_local_checks(step, suggestions)
+
+
+def validate_steps_batched(steps, teamId, stepIndexes):
+    """Score all steps with a single content_suggestions request.
+
+    Returns None when the backend cannot batch so callers fall back to
+    per-step scoring.
+    """
+    if content_suggestions_batch is None:
+        return None
+
+    bodies = [
+        build_content_suggestions_body(step, index)
+        for index, step in zip(stepIndexes, steps)
+    ]
+
+    try:
+        with trace_stage("contentSuggestionsBatch", steps=len(bodies)):
+            results = content_suggestions_batch(bodies, teamId)
+    except Exception as e:
+        print(f"Error in batch scoring: {e}. Falling back to per-step calls...")
+        return None
+
+    if not isinstance(results, list) or len(results) != len(steps):
+        print("Batch scoring returned an unexpected number of results. Falling back to per-step calls...")
+        return None
+
+    return [apply_local_checks(step, suggestions) for step, suggestions in zip(steps, results)]
+
+
+# Prompts are module-level constants; the LangChain message prefixes built from
+# them are cached per process so each request only adds its final HumanMessage
+MODIFICATION_SYSTEM_PROMPT = """As a chatbot designed to help users update content, your job is to remove the provided words that are considered spammy, make the content more concise, remove any "hope", "trust", or "well" phrases, remove any invalid custom variables, and replace any text wrapped with [] with {[]} instead, (so that the updated text has both [] and {}), whilst ensuring that the content still reads well.
 
         # **Subject:**
         This is text that needs to be updated.
@@ -129,7 +1127,7 @@ def modify_failed_steps(failedSteps):
         Return your response as JSON with this structure:
         {"templates": [{"subject": "Updated subject", "body": "Updated body"}, ...]}"""
 
-    sample_user = """
+MODIFICATION_SAMPLE_USER = """
             **Subject:**
             "Opportunity for Senior Software Architect with 15+ Years Experience"
 
@@ -150,77 +1148,9 @@ def modify_failed_steps(failedSteps):
 
             **Invalid Custom Variables:** ["{{invalidVar}}"]"""
 
-    sample_assistant = """{"templates": [{"subject":"Senior Software Architect with 15+ Years Experience","body": "Dear {{firstName}},\\n\\nFollowing up on my previous email about the Senior Software Architect position. This candidate has over 15 years of experience in Microservices, cloud computing, and DevOps.\\n\\nThey are well-versed in agile methodologies and available for remote work – a perfect fit for {{company}}'s needs.\\n\\nCould we explore this opportunity further?\\n\\nBest regards,\\n{[senderFirstName]}"}, {"subject":"Exciting role at Innovatech Solutions!","body": "Hi {{firstName}},\\n\\nFollowing up on my previous email about the Full Stack Developer position at Innovatech Solutions. Your expertise in React, Node.js, and MongoDB align perfectly with our requirements.\\n\\nWe provide a culture of continuous learning, competitive compensation, and flexible work arrangements. If you're still interested, use this link to schedule a brief introductory chat: {[senderCalendarLink]}.\\n\\nLooking forward to connecting,\\n{[senderFirstName]}"}]}"""
-
-    user_prompt = create_modification_prompt(failedSteps)
-    
-    # Create the chain with few-shot examples
-    messages = [
-        SystemMessage(content=system_prompt + "\n" + modification_parser.get_format_instructions()),
-        HumanMessage(content=sample_user),
-        AIMessage(content=sample_assistant),
-        HumanMessage(content=user_prompt)
-    ]
-
-    max_retries = 3
-    retries = 0
-
-    while retries < max_retries:
-        try:
-            response = llm.invoke(messages)
-            parsed_response = modification_parser.parse(response.content)
-            
-            # Validate we have the correct number of templates
-            if len(parsed_response.templates) == len(failedSteps):
-                break
-                
-            retries += 1
-            print(f"Attempt {retries}: Incorrect number of templates. Retrying...")
-            
-        except Exception as e:
-            retries += 1
-            print(f"Attempt {retries}: Error parsing response: {e}. Retrying...")
-
-    if retries == max_retries:
-        print("Max retries reached. Aborting the modification process.")
-        return failedSteps
-
-    return [
-        {
-            **originalStep,
-            "body": updated_step.body,
-            "subject": updated_step.subject,
-        }
-        for (originalStep, _), updated_step in zip(failedSteps, parsed_response.templates)
-    ]
-
-
-def process_content_validation(content, teamId, stepIndex=0, threshold=70):
-    failedSteps = []
-
-    for index, item in enumerate(content if isinstance(content, list) else [content]):
-        currentStepIndex = stepIndex + index
-        suggestions = validate_content(item, currentStepIndex, teamId)
-
-        if suggestions["totalScore"]["num"] < threshold:
-            failedSteps.append((item, suggestions))
-
-    if failedSteps:
-        modifiedSteps = modify_failed_steps(failedSteps)
-        # Replace failed steps with modified versions
-        if isinstance(content, list):
-            for (oldStep, _), newStep in zip(failedSteps, modifiedSteps):
-                content[content.index(oldStep)] = newStep
-        else:
-            # on regeneration it's a single step
-            content = modifiedSteps[0]
-
-    return content
+MODIFICATION_SAMPLE_ASSISTANT = """{"templates": [{"subject":"Senior Software Architect with 15+ Years Experience","body": "Dear {{firstName}},\\n\\nFollowing up on my previous email about the Senior Software Architect position. This candidate has over 15 years of experience in Microservices, cloud computing, and DevOps.\\n\\nThey are well-versed in agile methodologies and available for remote work – a perfect fit for {{company}}'s needs.\\n\\nCould we explore this opportunity further?\\n\\nBest regards,\\n{[senderFirstName]}"}, {"subject":"Exciting role at Innovatech Solutions!","body": "Hi {{firstName}},\\n\\nFollowing up on my previous email about the Full Stack Developer position at Innovatech Solutions. Your expertise in React, Node.js, and MongoDB align perfectly with our requirements.\\n\\nWe provide a culture of continuous learning, competitive compensation, and flexible work arrangements. If you're still interested, use this link to schedule a brief introductory chat: {[senderCalendarLink]}.\\n\\nLooking forward to connecting,\\n{[senderFirstName]}"}]}"""
 
-
-@catch_errors()
-def chatbot_regenerate_response(userId, teamId, body):
-    system_prompt = """As a chatbot designed to help users update content, your job is to reword the content, whilst ensuring that the content is still concise. Make sure that both the Subject and Body are updated. The number of templates returned must match the number of templates submitted by the user. Never use the phrase "I hope this email/message finds you well". Never use emojis.
+REGENERATION_SYSTEM_PROMPT = """As a chatbot designed to help users update content, your job is to reword the content, whilst ensuring that the content is still concise. Make sure that both the Subject and Body are updated. The number of templates returned must match the number of templates submitted by the user. Never use the phrase "I hope this email/message finds you well". Never use emojis.
 
         # **Subject:**
         This is text that needs to be updated.
@@ -231,7 +1161,7 @@ def chatbot_regenerate_response(userId, teamId, body):
         Return your response as JSON with this structure:
         {"templates": {"subject": "Updated subject", "body": "Updated body"}}"""
 
-    sample_user = """
+REGENERATION_SAMPLE_USER = """
             **Subject:**
             "{{firstName}}, A Creative Opportunity Awaits"
 
@@ -239,74 +1169,15 @@ def chatbot_regenerate_response(userId, teamId, body):
             "Hey {{firstName}},\n\nIt's {[senderFirstName]} from DesignSphere,\n\nGot a minute to chat?\n We have an exciting Graphics Designer role in London.\nLet's connect!\n\nBest,\n{[senderFirstName]}"
             """
 
-    sample_assistant = """{"templates": {"subject":"An Exciting Opportunity Awaits!","body": "It's {[senderFirstName]} from DesignSphere,\\n\\nWe have a promising Graphics Designer role in London.\\n\\nLet's chat! Best,\\n{[senderFirstName]}"}}"""
-
-    user_prompt = f"""
-        **Subject:**
-        {body["subject"]}
-
-        **Body:**
-        {body["body"]}
-    """
-
-    messages = [
-        SystemMessage(content=system_prompt + "\n" + regeneration_parser.get_format_instructions()),
-        HumanMessage(content=sample_user),
-        AIMessage(content=sample_assistant),
-        HumanMessage(content=user_prompt)
-    ]
-
-    max_retries = 3
-    retries = 0
-    original_body = body["body"]
-
-    while retries < max_retries:
-        try:
-            response = llm.invoke(messages)
-            parsed_response = regeneration_parser.parse(response.content)
-            
-            new_body = parsed_response.templates.body
-            
-            if new_body != original_body:
-                data = {"content": {"templates": parsed_response.templates.dict()}, "id": body["messageId"]}
-                break
-                
-            retries += 1
-            print(f"Attempt {retries}: Generated content is the same as original. Retrying...")
-            
-        except Exception as e:
-            retries += 1
-            print(f"Attempt {retries}: Error parsing response: {e}. Retrying...")
-
-    if retries == max_retries:
-        print("Max retries reached. Using the last generated content.")
-        # Fallback to original content if all retries failed
-        data = {"content": {"templates": {"subject": body["subject"], "body": body["body"]}}, "id": body["messageId"]}
-
-    _, step_str = body["messageId"].split("-step")
-
-    data["content"]["templates"] = process_content_validation(
-        data["content"]["templates"], teamId, int(step_str) - 1
-    )
-
-    broadcast_to_user(
-        userId, "aiRegenerateCampaignResponse", data, pathnames=["/campaigns"]
-    )
-
-
-@catch_errors()
-def chatbot_response(userId, teamId, body):
-    timezone = get_user(userId).get("timezone") or ""
-    locale = "British English" if timezone.startswith("Europe") else "American English"
+REGENERATION_SAMPLE_ASSISTANT = """{"templates": {"subject":"An Exciting Opportunity Awaits!","body": "It's {[senderFirstName]} from DesignSphere,\\n\\nWe have a promising Graphics Designer role in London.\\n\\nLet's chat! Best,\\n{[senderFirstName]}"}}"""
 
-    outreachPrompts = {
-        "businessDevelopment": "As a chatbot designed to assist users in crafting targeted outreach campaigns for business development, your task involves creating an outreach campaign based on the user-provided details, which will include the types of steps and their sequence. Each step is designed to leverage user-provided information to effectively connect with potential clients and promote the advantages of the user's services.",
-        "candidateSourcing": "As a chatbot designed to assist users in crafting targeted outreach campaigns to source candidates for specific job roles, your task involves creating an outreach campaign based on the user-provided details about the position and the ideal candidate. Each step in the campaign should be tailored to attract and engage potential candidates, highlighting the key aspects of the job opportunity and the company.",
-        "candidateSpec": "As a chatbot designed to assist users in presenting highly qualified candidates to potential employers, your task involves creating an outreach campaign to showcase the candidate's skills, experience, and suitability for the target job roles. Each step in the campaign should highlight the candidate's strengths and value proposition, aiming to capture the attention of potential employers and secure the next steps in the hiring process.",
-    }
+OUTREACH_PROMPTS = {
+    "businessDevelopment": "As a chatbot designed to assist users in crafting targeted outreach campaigns for business development, your task involves creating an outreach campaign based on the user-provided details, which will include the types of steps and their sequence. Each step is designed to leverage user-provided information to effectively connect with potential clients and promote the advantages of the user's services.",
+    "candidateSourcing": "As a chatbot designed to assist users in crafting targeted outreach campaigns to source candidates for specific job roles, your task involves creating an outreach campaign based on the user-provided details about the position and the ideal candidate. Each step in the campaign should be tailored to attract and engage potential candidates, highlighting the key aspects of the job opportunity and the company.",
+    "candidateSpec": "As a chatbot designed to assist users in presenting highly qualified candidates to potential employers, your task involves creating an outreach campaign to showcase the candidate's skills, experience, and suitability for the target job roles. Each step in the campaign should highlight the candidate's strengths and value proposition, aiming to capture the attention of potential employers and secure the next steps in the hiring process.",
+}
 
-    systemPrompt = outreachPrompts[body["outreachType"]]
-    systemPrompt += """
+CAMPAIGN_SYSTEM_PROMPT = """
 
     When generating the campaign, the content of each step should take into account the previous step content, ensuring a coherent sequence. Where sensible, use at least three custom variables each step, ensuring they're selected from the list provided and used correctly. To help you understand the expected response, you will be provided with sample user input and expected assistant responses. Your output should only include data from the latest user input and should not include copied data from the expected assistant responses.
 
@@ -361,18 +1232,25 @@ def chatbot_response(userId, teamId, body):
 
         **Always make sure to**: Never use the phrase "I hope this email/message finds you well". Never use emojis."""
 
-    systemPrompt += f"""
+CAMPAIGN_SYSTEM_PROMPT += f"""
 
         ### Personalization and Connection
         - **Custom Variables**: Only use the following custom variables: {", ".join(VALID_CUSTOM_VARS)}. Integrate at least three in each step, ensuring they're used correctly.
 
         ### Content Requirements
-        - **Language**: Use {locale}, avoiding spam terms and clichés. Strive for concise, clear emails.
+        - **Language**: Use the language specified by the user, avoiding spam terms and clichés. Strive for concise, clear emails.
         - **Relevance**: Ensure content is specific to the recipient's needs and straightforward, without unnecessary details or complex explanations."""
 
-    samplePrompts = {
-        "candidateSourcing": {
-            "userNonHiringName": """## User-Provided Details
+
+def campaign_language_prompt(locale):
+    # per-request variables go after the few-shot examples so that the system
+    # prompt and samples form a stable prefix for the provider's prompt cache
+    return "\n".join(["", "", "## Language", "", f"- **Language:** {locale}"])
+
+
+SAMPLE_PROMPTS = {
+    "candidateSourcing": {
+        "userNonHiringName": """## User-Provided Details
 
                 - **Include Hiring Company Name**
                 "no"
@@ -400,9 +1278,9 @@ def chatbot_response(userId, teamId, body):
                 4. phoneCall
                 5. email
                 6. linkedinConnectionRequest""",
-            "assistantNonHiringName": """
+        "assistantNonHiringName": """
                 {{"title":"Search - Head of Product, Oregon", "templates": [{{"subject": "{{firstName}} : Head of Product - Oregon", "body": "Dear {{firstName}},\\n\\nI wanted to reach out and share an exciting role that I believe aligns with your expertise and experience. We're currently seeking a talented and driven individual to join our client as a critical position in their Product team based in Oregon.\\n\\nYour background is very impressive and i'd love to speak in more detail. What date works best?\\n\\nKind regards,\\n{[senderFirstName]}", "mailType": "email"}},{{"body": "Call candidate", "mailType": "phoneCall"}},{{"subject": "{{firstName}} : Head of Product - Oregon", "body": "Hi {{firstName}},\\n\\nI messaged you on {[previousStepDay]}, as having reviewed your profile I was keen to speak with you about a role I am currently working on.\\n\\nI appreciated how these messages can be caught up in email filters, so thought I would message you again.\\n\\nThe role we are working on is for a Head of Product, who will shape the product roadmap and establish industry leading processes.\\n\\nI thought that your experience, including your time working for {{company}}, made you a potential fit. What do you think?\\n\\nRegards,\\n{[senderFirstName]}", "mailType": "email"}},{{"body": "Call candidate", "mailType": "phoneCall"}},{{"subject": "{{firstName}} : Head of Product - Oregon", "body": "Hi {{firstName}}, I appreciate you will be busy.\\n\\nLet me know if this is worth discussing {[tomorrow]} or {[twoWorkingDays]}, or whether there is someone else I should speak to?\\n\\nRegards,\\n{[senderFirstName]}", "mailType": "email"}},{{"body": "Hi {{firstName}},\\n\\nI am working across the tech space specialising in product roles to build and scale teams, it would be good to connect.", "mailType": "linkedinConnectionRequest"}}]}""",
-            "userHiringName": """## User-Provided Details
+        "userHiringName": """## User-Provided Details
 
                 - **Include Hiring Company Name**
                 "yes"
@@ -428,9 +1306,9 @@ def chatbot_response(userId, teamId, body):
                 5. phoneCall
                 6. email
                 7. linkedinConnectionRequest""",
-            "assistantHiringName": """
+        "assistantHiringName": """
                 {{"title":"SWCompanyExample - PL/SQL - Oracle Database Developer", "templates": [{{"subject": "{{firstName}}, Would Love To Chat!", "body": "Good {[timeOfDay]} {{firstName}}, happy {[dayOfWeek]}!\\n\\nI'm guessing you're a pretty solid {{role}} given your experience at {{company}}. Your background over the last several years really impressed me!\\n\\nJust out of curiosity, are you considering a change? A client of mine at SWCompanyExample has a remote Oracle Database Developer role available and is looking for someone like yourself to join them.\\n\\nDo you have time {[tomorrow]} to discuss?", "mailType": "email"}},{{"subject": "{{firstName}}, Do You Have A Minute?", "body": "Good {[timeOfDay]} {{firstName}},\\n\\nI tried to connect with you via e-mail {[previousStepDay]}.\\n\\nDo you have time to discuss later or {[tomorrow]}?\\n\\nRegards, {[senderFirstName]}", "mailType": "inmail"}},{{"body": "{{firstName}},\\n\\nThis is {[senderFirstName]} from The Jupiter Group. Are you currently on the market? There's a PL/SQL - Database Developer position available you'd be a great fit for. Let me know if you have a minute.", "mailType": "sms"}},{{"subject": "{{firstName}}, Would Love To Chat!", "body": "Hi {{firstName}},\\n\\nFollowing up on my previous e-mail...\\n\\nHave time for a quick chat {[tomorrow]}?\\n\\nRegards,\\n\\n{[senderFirstName]}", "mailType": "email"}},{{"body": "Call Candidate", "mailType": "phoneCall"}},{{"subject": "{{firstName}}, Would Love To Chat!", "body": "{{firstName}},\\n\\nThings must be going well at {{company}} and I very much respect that! Let's connect on Linkedin instead?\\n\\nRegards,\\n\\n{[senderFirstName]}", "mailType": "email"}},{{"body": "{{firstName}}, I'd love to connect and share our networks! If you were ever exploring the job market, will you let me know?", "mailType": "linkedinConnectionRequest"}}]}""",
-            "userInHouse": """## User-Provided Details
+        "userInHouse": """## User-Provided Details
 
                 - **Position title & description:**
                 Head of Product, will establish industry-leading product management practices at our fintech company that operates in 13 markets. Head of product will drive both strategic direction and agile execution, shaping the product roadmap and ensuring every decision aligns with the company mission as well as driving new product growth.
@@ -453,11 +1331,11 @@ def chatbot_response(userId, teamId, body):
                 5. email
                 6. linkedinConnectionRequest
                 7. email""",
-            "assistantInHouse": """
+        "assistantInHouse": """
                  {{"title":"Head of Product Outreach - Oregon", "templates": [{{"subject": "{{firstName}} : Head of Product - Oregon", "body": "Dear {{firstName}},\\n\\nWe're currently on the look out for a Head of Product to join our rapidly growing FinTech company, with ambitious plans operating in 13 markets.\\n\\nI wanted to reach out and share an exciting role that I believe aligns with your expertise and experience. We're looking for someone to drive the strategic direction and join the team based in Oregon.\\n\\nYour background is very impressive and i'd love to speak in more detail. What date works best?\\n\\nKind regards, {[senderFirstName]}", "mailType": "email"}},{{"body": "Call candidate", "mailType": "phoneCall"}},{{"subject": "{{firstName}} : Head of Product - Oregon", "body": "Hi {{firstName}},\\n\\nI messaged you on {[previousStepDay]}, regarding a Head of Product role I am currently hiring for.\\n\\nI appreciated how these messages can be caught up in email filters, so thought I would message you again. The right fit will be instrumental in shaping our product strategy. Head of Product will oversee the development of new products, as well as drive the growth of existing ones.\\n\\nYour experience, including your time working for {{company}}, makes you a potential fit.\\n\\nWhat do you think?\\n\\nRegards, {[senderFirstName]}", "mailType": "email"}},{{"body": "Call candidate", "mailType": "phoneCall"}},{{"subject": "{{firstName}} : Head of Product - Oregon", "body": "Hi {{firstName}},\\n\\nI appreciate you will be busy. Let me know if this is worth discussing {[tomorrow]} or perhaps {[twoWorkingDays]}?\\n\\nRegards, {[senderFirstName]}", "mailType": "email"}},{{"body": "Hi {{firstName}},\\n\\nI emailed you about a Head of Product role we are recruiting for. We are expanding our tech hub in Oregon and looking for professionals to join. It would be great to connect!\\n\\n{[senderFirstName]}", "mailType": "linkedinConnectionRequest"}},{{"subject": "{{firstName}} : Head of Product - Oregon", "body": "Hi {{firstName}},\\n\\nAppreciate inboxes can be busy, so thought I would try reaching out just one last time about a role we are recruiting for.\\n\\nOf course, if you are not looking for a change, just let me know. Either way, I will be happy to stay in touch!\\n\\nRegards, {[senderFirstName]}", "mailType": "email"}}]}}""",
-        },
-        "businessDevelopment": {
-            "userOne": """## User-Provided Details
+    },
+    "businessDevelopment": {
+        "userOne": """## User-Provided Details
 
                 - **What we offer:**
                 "SourceWhale is a cutting-edge technology designed for recruiters in the recruitment technology (rec-tech) space. It enables seamless booking of meetings with both candidates and clients, improving efficiency and response rates."
@@ -484,11 +1362,11 @@ def chatbot_response(userId, teamId, body):
                 6. phoneCall
                 7. email
                 8. email""",
-            "assistantOne": """
+        "assistantOne": """
                 {{"title":"BD Outreach - Nurture", "templates": [{{"subject": "Source Business With SourceWhale", "body": "{{firstName}},\\n\\nWe're finding many recruiters are currently struggling to source business and receive responses from existing candidates.\\n\\nNot sure if this is something you're bumping into at {{company}} but SourceWhale is a piece of tech that enables recruiters in the rec-tech space to book more meetings with candidates and clients.\\n\\nFancy having a quick chat to see what we do?\\n\\nThanks,\\n{[senderFirstName]}", "mailType": "email"}},{{"body": "Call to discuss email", "mailType": "phoneCall"}},{{"body": "{{firstName}} - good to connect! I sent an email across this morning, wasn't sure if it was relevant in the end? (My guess is your inbox is rather crowded, so thought I'd shoot a quick message on LinkedIn!)", "mailType": "linkedinConnectionRequest"}},{{"subject": "Source Business With SourceWhale", "body": "Hi {{firstName}},\\n\\nConscious my first email was a little vague and I didn't explain how we actually do it! SourceWhale integrates with your existing tech (CRM/Email/LinkedIn) to simplify workflow, offer targeted outreach and track everything so nothing gets missed.\\n\\nOther recruiters are using it on both the candidate and BD side - What are you primarily focused on at the moment?\\n\\nThanks again,\\n{[senderFirstName]}", "mailType": "email"}},{{"subject": "Source Business With SourceWhale", "body": "Hi {{firstName}} - I've sent a few emails but can imagine your inbox is rather crowded!\\n\\nWe're working with several headhunters who are saying focus has changed - from candidate short to more Business Development. Not sure if you're seeing something similar?\\n\\nIf you are, we can help - might not be a bad idea to have a chat?", "mailType": "inmail"}},{{"body": "Call to discuss email", "mailType": "phoneCall"}},{{"subject": "Source Business With SourceWhale", "body": "Hi {{firstName}},\\n\\nFollowing up on my previous email, SourceWhale's technology accelerates candidate sourcing. Streamlining your recruitment processes with our extension which can boost engagement, drive more meetings, and increase your revenue.\\n\\nDo you have time for a quick chat this week?\\n\\n{[senderFirstName]}", "mailType": "email"}},{{"subject": "Source Business With SourceWhale", "body": "{{firstName}},\\n\\nI'm guessing a candidate/business development push isn't the priority right now - which is completely fine.\\nAlways keen to share how you can drive engagement, happy to catch up later in the year?\\n\\nBest,\\n{[senderFirstName]}", "mailType": "email"}}]}""",
-        },
-        "candidateSpec": {
-            "userOne": """## User-Provided Details
+    },
+    "candidateSpec": {
+        "userOne": """## User-Provided Details
 
                 - **Candidate experience and qualifications:**
                 "Principal Firmware Engineer"
@@ -511,281 +1389,1222 @@ def chatbot_response(userId, teamId, body):
                 5. email
                 6. phoneCall
                 7. email""",
-            "assistantOne": """
+        "assistantOne": """
                 {{"title":"Spec - Principal Firmware Engineer - Boston, MA", "templates": [{{"subject": "Principal Firmware Engineer - Actively Looking in Boston, MA", "body": "Hi {{firstName}},\\n\\nI am representing a highly skilled Principal Firmware Engineer that is actively looking for a role in Boston, MA and has asked me to make an introduction to {{company}} on their behalf.\\n\\nA summary of their experience is below.\\nPrincipal Firmware Engineer - 20+ years' experience in Embedded Software Engineering.\\nProducts include Robotics, Surgical Equipment, Heart Pumps\\nBackground in Bluetooth & Wireless devices.\\n\\nThey would like to start having conversations early next week and have highlighted {{company}} as one they are interested in as part of their targeted search.\\nAre you available this week to discuss next steps?\\n\\nRegards, {[senderFirstName]}", "mailType": "email"}},{{"body": "Hi {{firstName}},\\n\\nI am representing a number of candidates that would be interested in being introduced to {{company}}.\\n\\nI have 10+ years experience in Medical Device Staffing.\\n\\nWould you be interested in connecting? {[senderFirstName]}", "mailType": "linkedinConnectionRequest"}},{{"subject": "Principal Firmware Engineer - Actively Looking in Boston, MA", "body": "Hi {{firstName}},\\n\\nFurther to my connection on LinkedIn, I just wanted to follow up on my previous email about a Principal Firmware Engineer who mentioned {{company}} as a company of interest in their search in Boston.\\n\\n- 20+ year experience in Firmware Engineering\\n- 8+ years in Complex Med-Devices\\n- Immediate start\\n\\nCould we arrange an exploratory discussion with the candidate?\\n\\nRegards, {[senderFirstName]}", "mailType": "email"}},{{"body": "Call Client", "mailType": "phoneCall"}},{{"subject": "Principal Firmware Engineer - Actively Looking in Boston, MA", "body": "Hi {{firstName}},\\n\\nI attempted to contact your mobile but we didn't manage to connect. What did you think about the resume I sent? {{company}} may not be looking to add additional resource currently.\\n\\nI recently placed candidates for another client and they were able to complete national installs ahead of time resulting in significant reduction in time taken to generate multiple additional revenue streams.\\n\\nWould something like this add value to {{company}}? When can we discuss?\\n\\nRegards,\\n{[senderFirstName]}", "mailType": "email"}},{{"body": "Call Client", "mailType": "phoneCall"}},{{"subject": "Principal Firmware Engineer - Actively Looking in Boston, MA", "body": "Hi, {{firstName}},\\n\\n{{company}} remain a business of interest due to success we have had locally and in the same industry. Let me know if you're interested in viewing some data on our global clients, and technical capabilities.\\n\\nI would be really keen to have a further conversation about {{company}} and Proclinical working together. Would a partner like us add any value?\\n\\nThanks, {[senderFirstName]}", "mailType": "email"}}]}""",
-        },
-    }
+    },
+}
+
+
+def randomize_campaign_steps(data):
+    outreachType = data["outreachType"]
+    channels = data["channels"]
+    numSteps = int(data["selectedNumOfSteps"])
+
+    firstStep = (
+        "email"
+        if outreachType in ["businessDevelopment", "candidateSpec"]
+        and "email" in channels
+        else random.choice([ch for ch in ["email", "inmail"] if ch in channels])
+        if outreachType == "candidateSourcing"
+        and any(ch in channels for ch in ["email", "inmail"])
+        else next((ch for ch in channels if ch != "phoneCall"), channels[0])
+    )
+
+    # Ensure that each channel is included at least once
+    remainingChannels = [ch for ch in channels if ch != firstStep]
+    campaignSteps = [firstStep] + random.sample(
+        remainingChannels, min(len(remainingChannels), numSteps - 1)
+    )
+
+    # If additional steps are still needed, add random steps from original channels
+    while len(campaignSteps) < numSteps:
+        campaignSteps.append(random.choice(channels))
+
+    # Only 1 linkedinConnectionRequest is allowed
+    if campaignSteps.count("linkedinConnectionRequest") > 1:
+        linkedinIndices = [
+            i
+            for i, step in enumerate(campaignSteps)
+            if step == "linkedinConnectionRequest"
+        ]
+        for index in linkedinIndices[1:]:
+            campaignSteps[index] = random.choice(
+                [ch for ch in channels if ch != "linkedinConnectionRequest"]
+            )
+
+    # Shuffle the steps (apart from the first step) to randomize the campaign
+    campaignSteps = [campaignSteps[0]] + random.sample(
+        campaignSteps[1:], len(campaignSteps) - 1
+    )
 
-    def randomize_campaign_steps(data):
-        outreachType = data["outreachType"]
-        channels = data["channels"]
-        numSteps = int(data["selectedNumOfSteps"])
-
-        firstStep = (
-            "email"
-            if outreachType in ["businessDevelopment", "candidateSpec"]
-            and "email" in channels
-            else random.choice([ch for ch in ["email", "inmail"] if ch in channels])
-            if outreachType == "candidateSourcing"
-            and any(ch in channels for ch in ["email", "inmail"])
-            else next((ch for ch in channels if ch != "phoneCall"), channels[0])
+    return campaignSteps
+
+
+def tone_sample(campaignId, campaign):
+    """Text used to replicate a campaign's tone, capped at TONE_SAMPLE_MAX_TOKENS.
+
+    Cached per campaign id and content hash, so edits to the source
+    campaign produce a fresh sample.
+    """
+    contents = [template["content"] for template in campaign["templates"].values()]
+    contentHash = hashlib.sha256("\x00".join(contents).encode("utf-8")).hexdigest()
+    key = f"{campaignId}:{contentHash}"
+
+    sample = tone_sample_cache.get(key)
+    if sample is not None:
+        return sample
+
+    # roughly four characters per token
+    maxChars = TONE_SAMPLE_MAX_TOKENS * 4
+    texts = []
+    length = 0
+    for content in contents:
+        text = html_to_text(content)
+        texts.append(text)
+        length += len(text) + 1
+        if length > maxChars:
+            break
+
+    sample = " ".join(texts)
+    if len(sample) > maxChars:
+        sample = sample[:maxChars].rsplit(" ", 1)[0]
+
+    tone_sample_cache.set(key, sample)
+    return sample
+
+
+def build_user_prompt(body, mailTypes, campaign=None):
+    parts = ["## User-Provided Details", ""]
+
+    # Candidate Sourcing fields
+    if body["outreachType"] == "candidateSourcing":
+        parts.append(
+            f'- **Include Hiring Company Name:** {body["includeHiringCompanyName"]}'
         )
 
-        # Ensure that each channel is included at least once
-        remainingChannels = [ch for ch in channels if ch != firstStep]
-        campaignSteps = [firstStep] + random.sample(
-            remainingChannels, min(len(remainingChannels), numSteps - 1)
+        parts.append(
+            f'- **Hiring Company Name:** {body["hiringCompanyName"]}'
+            if "hiringCompanyName" in body
+            else ""
         )
 
-        # If additional steps are still needed, add random steps from original channels
-        while len(campaignSteps) < numSteps:
-            campaignSteps.append(random.choice(channels))
+        parts.append(
+            f'- **Position title & description:** {body["positionDetails"]}'
+        )
 
-        # Only 1 linkedinConnectionRequest is allowed
-        if campaignSteps.count("linkedinConnectionRequest") > 1:
-            linkedinIndices = [
-                i
-                for i, step in enumerate(campaignSteps)
-                if step == "linkedinConnectionRequest"
-            ]
-            for index in linkedinIndices[1:]:
-                campaignSteps[index] = random.choice(
-                    [ch for ch in channels if ch != "linkedinConnectionRequest"]
-                )
+        parts.append(f'- **Job Location:** {body["jobLocation"]}')
 
-        # Shuffle the steps (apart from the first step) to randomize the campaign
-        campaignSteps = [campaignSteps[0]] + random.sample(
-            campaignSteps[1:], len(campaignSteps) - 1
+    # Business development fields
+    if body["outreachType"] == "businessDevelopment":
+        parts.append(f'- **What we offer:** {body["whatWeOffer"]}')
+        parts.append(f'- **Pain point:** {body["buyerPainPoint"]}')
+        parts.append(f'- **Value proposition:** {body["valueProposition"]}')
+
+    # Candidate Spec fields
+    if body["outreachType"] == "candidateSpec":
+        parts.append(
+            f'- **Candidate experience and qualifications:** {body["experience"]}'
         )
+        parts.append(f'- **Candidate key skills:** {body["skills"]}')
 
-        # Create the new campaign step sequence
-        campaignSteps = "\n".join(
-            f"{i+1}. {step}" for i, step in enumerate(campaignSteps)
+    # Generic fields
+    if body["campaignTone"] == "casual":
+        parts.append(
+            "- **Tone:** Keep it clear, engaging, and personable. Use conversational language and contractions to make messages feel like a friendly chat."
+        )
+    elif body["campaignTone"] == "professional":
+        parts.append(
+            "- **Tone:** Maintain a professional and formal tone. Use clear and concise language, avoid contractions, and ensure messages convey a sense of expertise and credibility."
+        )
+    elif body["campaignTone"] == "replicateTone":
+        if campaign is None:
+            campaign = get_campaign(body["selectedCampaign"])
+        content = tone_sample(body["selectedCampaign"], campaign)
+        parts.append(
+            f'- **Tone:** Mimic the tone from the following text: "{content}"'
         )
 
-        return campaignSteps
+    if "callToAction" in body:
+        parts.append(f'- **Call to action:** {body["callToAction"]}')
+    if "additionalContext" in body:
+        parts.append(f'- **Additional context:** {body["additionalContext"]}')
 
-    def add_system_and_sample_prompt(body, systemPrompt):
-        messages = [
-            {"role": "system", "content": systemPrompt},
-        ]
-        # only candidateSourcing displays includeHiringCompanyName
-        # if user is inHouse, includeHiringCompanyName is hidden and we use a different samplePrompt
-        if body["outreachType"] == "candidateSourcing":
-            if body["includeHiringCompanyName"] == "yes":
-                messages.extend(
-                    [
-                        {
-                            "role": "user",
-                            "content": samplePrompts[body["outreachType"]][
-                                "userHiringName"
-                            ],
-                        },
-                        {
-                            "role": "assistant",
-                            "content": samplePrompts[body["outreachType"]][
-                                "assistantHiringName"
-                            ],
-                        },
-                    ]
-                )
-            else:
-                if body["isInHouse"]:
-                    messages.extend(
-                        [
-                            {
-                                "role": "user",
-                                "content": samplePrompts[body["outreachType"]][
-                                    "userInHouse"
-                                ],
-                            },
-                            {
-                                "role": "assistant",
-                                "content": samplePrompts[body["outreachType"]][
-                                    "assistantInHouse"
-                                ],
-                            },
-                        ]
-                    )
-                else:
-                    messages.extend(
-                        [
-                            {
-                                "role": "user",
-                                "content": samplePrompts[body["outreachType"]][
-                                    "userNonHiringName"
-                                ],
-                            },
-                            {
-                                "role": "assistant",
-                                "content": samplePrompts[body["outreachType"]][
-                                    "assistantNonHiringName"
-                                ],
-                            },
-                        ]
-                    )
+    if "replicateUserStyle" in body:
+        parts.extend(
+            [
+                "",
+                "## Writing Style",
+                "",
+                "Replicate the user's writing style from the following text snippets:",
+                "",
+                '- ""',
+                '- ""',
+                '- ""',
+            ]
+        )
+
+    parts.extend(["", "## Campaign Step Sequence", ""])
+    parts.extend(f"{i+1}. {mailType}" for i, mailType in enumerate(mailTypes))
+
+    return "\n".join(parts)
+
+
+def sample_prompt_variant(body):
+    # only candidateSourcing displays includeHiringCompanyName
+    # if user is inHouse, includeHiringCompanyName is hidden and we use a different samplePrompt
+    if body["outreachType"] == "candidateSourcing":
+        if body["includeHiringCompanyName"] == "yes":
+            return "HiringName"
+        if body["isInHouse"]:
+            return "InHouse"
+        return "NonHiringName"
+    return "One"
+
+
+@lru_cache(maxsize=None)
+def campaign_prompt_prefix(outreachType, variant):
+    """System and few-shot messages for a campaign, built once per process."""
+    init_langchain()
+
+    systemPrompt = OUTREACH_PROMPTS[outreachType] + CAMPAIGN_SYSTEM_PROMPT
+    samples = SAMPLE_PROMPTS[outreachType]
+
+    return (
+        SystemMessage(content=systemPrompt + "\n" + campaign_parser.get_format_instructions()),
+        HumanMessage(content=samples["user" + variant]),
+        AIMessage(content=samples["assistant" + variant]),
+    )
+
+
+@lru_cache(maxsize=None)
+def modification_prompt_prefix():
+    init_langchain()
+    return (
+        SystemMessage(content=MODIFICATION_SYSTEM_PROMPT + "\n" + modification_parser.get_format_instructions()),
+        HumanMessage(content=MODIFICATION_SAMPLE_USER),
+        AIMessage(content=MODIFICATION_SAMPLE_ASSISTANT),
+    )
+
+
+@lru_cache(maxsize=None)
+def repair_prompt_prefix():
+    init_langchain()
+    return (
+        SystemMessage(content=MODIFICATION_SYSTEM_PROMPT + "\n" + modification_parser.get_format_instructions()),
+    )
+
+
+@lru_cache(maxsize=None)
+def regeneration_prompt_prefix():
+    init_langchain()
+    return (
+        SystemMessage(content=REGENERATION_SYSTEM_PROMPT + "\n" + regeneration_parser.get_format_instructions()),
+        HumanMessage(content=REGENERATION_SAMPLE_USER),
+        AIMessage(content=REGENERATION_SAMPLE_ASSISTANT),
+    )
+
+
+json_decoder = json.JSONDecoder()
+
+
+def extract_json(content):
+    """Decode the first JSON object in a completion.
+
+    Tolerates code fences and leading or trailing text around the JSON,
+    so such responses don't need a retry.
+    """
+    start = content.find("{")
+    if start == -1:
+        raise ValueError("no JSON object in response")
+    value, _ = json_decoder.raw_decode(content, start)
+    return value
+
+
+def substitute_company(text, hiringCompanyName):
+    if hiringCompanyName and isinstance(text, str) and "SWCompanyExample" in text:
+        return text.replace("SWCompanyExample", hiringCompanyName)
+    return text
+
+
+def mask_company(text, hiringCompanyName):
+    """The reverse of substitute_company, for text kept beyond this request.
+    Only whole-word occurrences are masked ("Meta" but not "Metaverse")."""
+    if hiringCompanyName and isinstance(text, str) and hiringCompanyName in text:
+        pattern = rf"(?<!\w){re.escape(hiringCompanyName)}(?!\w)"
+        return re.sub(pattern, "SWCompanyExample", text)
+    return text
+
+
+class StepRecord:
+    """A validated campaign template."""
+
+    __slots__ = ("subject", "body", "mailType")
+
+    def __init__(self, subject, body, mailType):
+        self.subject = subject
+        self.body = body
+        self.mailType = mailType
+
+    @classmethod
+    def from_dict(cls, template):
+        if not isinstance(template, dict):
+            raise ValueError("template is not an object")
+        subject = template.get("subject")
+        body = template.get("body")
+        mailType = template.get("mailType")
+        if (
+            type(body) is not str
+            or type(mailType) is not str
+            or (subject is not None and type(subject) is not str)
+        ):
+            raise ValueError("template has a missing or non-string field")
+        return cls(subject, body, mailType)
+
+    def to_dict(self, hiringCompanyName=None):
+        # SWCompanyExample (taken from samplePrompts) is replaced in the same pass
+        return {
+            "subject": substitute_company(self.subject, hiringCompanyName),
+            "body": substitute_company(self.body, hiringCompanyName),
+            "mailType": self.mailType,
+        }
+
+
+def parse_campaign(content):
+    """Parse a campaign completion into (title, [StepRecord, ...])."""
+    data = extract_json(content)
+    templates = data.get("templates") if isinstance(data, dict) else None
+    if not isinstance(templates, list):
+        raise ValueError("response has no templates list")
+
+    title = data.get("title")
+    if not isinstance(title, str):
+        # fallback in case the output is missing title
+        title = "AI Generated Campaign"
+
+    return title, [StepRecord.from_dict(template) for template in templates]
+
+
+def company_name(body):
+    # in case the output includes SWCompanyExample (taken from samplePrompts)
+    if (
+        body["outreachType"] == "candidateSourcing"
+        and body["includeHiringCompanyName"] == "yes"
+    ):
+        return body["hiringCompanyName"]
+    return None
+
+
+def parse_modified_templates(content, count):
+    """Parse a modification response into `count` slots.
+
+    Templates are matched to failed steps by position, so that is only safe
+    when the count matches: on a mismatch every slot is None and all of them
+    are requested again. Otherwise only malformed templates' slots are None.
+    """
+    parsed = extract_json(content)
+    templates = parsed.get("templates") if isinstance(parsed, dict) else parsed
+    if isinstance(templates, dict):
+        templates = [templates]
+    if not isinstance(templates, list) or len(templates) != count:
+        return [None] * count
+
+    slots = []
+    for template in templates:
+        if isinstance(template, dict) and isinstance(template.get("body"), str):
+            slots.append({"subject": template.get("subject") or "", "body": template["body"]})
         else:
-            messages.extend(
-                [
-                    {
-                        "role": "user",
-                        "content": samplePrompts[body["outreachType"]]["userOne"],
-                    },
-                    {
-                        "role": "assistant",
-                        "content": samplePrompts[body["outreachType"]]["assistantOne"],
-                    },
-                ]
-            )
+            slots.append(None)
 
-        return messages
+    return slots
 
-    def build_user_prompt(body):
-        parts = ["## User-Provided Details", ""]
 
-        # Candidate Sourcing fields
-        if body["outreachType"] == "candidateSourcing":
-            parts.append(
-                f'- **Include Hiring Company Name:** {body["includeHiringCompanyName"]}'
-            )
+def modify_failed_steps(failedSteps, usage=None, escalated=False):
+    client = route_llm("modification", escalated)
 
-            parts.append(
-                f'- **Hiring Company Name:** {body["hiringCompanyName"]}'
-                if "hiringCompanyName" in body
-                else ""
-            )
+    updatedSteps = [None] * len(failedSteps)
+    pending = list(range(len(failedSteps)))
 
-            parts.append(
-                f'- **Position title & description:** {body["positionDetails"]}'
-            )
+    max_retries = 3
+    retries = 0
+
+    while pending and retries < max_retries:
+        user_prompt = create_modification_prompt([failedSteps[index] for index in pending])
+
+        if retries == 0:
+            # Create the chain with few-shot examples
+            route = "modification"
+            messages = [*modification_prompt_prefix(), HumanMessage(content=user_prompt)]
+        else:
+            # only re-request the missing or broken templates, without few-shots
+            route = "repair"
+            messages = [*repair_prompt_prefix(), HumanMessage(content=user_prompt)]
+
+        retries += 1
+        if retries > 1:
+            trace_increment("retries")
+        response = None
+        try:
+            response = response_cache.invoke(messages, client=client)
+            record_usage(route, response)
+            if usage is not None:
+                usage["tokens"] += response_token_count(response)
+            with trace_stage("parse"):
+                templates = parse_modified_templates(response.content, len(pending))
+        except CircuitOpenError as e:
+            print(f"{e}. Aborting the modification process.")
+            break
+        except Exception as e:
+            if response is not None:
+                response_cache.discard(messages, response.content, client)
+            print(f"Attempt {retries}: Error parsing response: {e}. Retrying...")
+            continue
 
-            parts.append(f'- **Job Location:** {body["jobLocation"]}')
+        # keep the templates that parsed; only re-check the ones just requested
+        for index, template in zip(pending, templates):
+            if template is not None:
+                updatedSteps[index] = template
 
-        # Business development fields
-        if body["outreachType"] == "businessDevelopment":
-            parts.append(f'- **What we offer:** {body["whatWeOffer"]}')
-            parts.append(f'- **Pain point:** {body["buyerPainPoint"]}')
-            parts.append(f'- **Value proposition:** {body["valueProposition"]}')
+        pending = [index for index in pending if updatedSteps[index] is None]
+        if pending:
+            response_cache.discard(messages, response.content, client)
+            print(f"Attempt {retries}: {len(pending)} template(s) missing or malformed. Repairing...")
 
-        # Candidate Spec fields
-        if body["outreachType"] == "candidateSpec":
-            parts.append(
-                f'- **Candidate experience and qualifications:** {body["experience"]}'
-            )
-            parts.append(f'- **Candidate key skills:** {body["skills"]}')
+    if pending:
+        print(f"Max retries reached. Keeping {len(pending)} step(s) unmodified.")
 
-        # Generic fields
-        if body["campaignTone"] == "casual":
-            parts.append(
-                "- **Tone:** Keep it clear, engaging, and personable. Use conversational language and contractions to make messages feel like a friendly chat."
+    return [
+        {**originalStep, **updatedStep} if updatedStep else originalStep
+        for (originalStep, _), updatedStep in zip(failedSteps, updatedSteps)
+    ]
+
+
+def validate_steps(steps, teamId, stepIndex=0, stepIndexes=None):
+    """Score every step concurrently, returning suggestions in step order.
+
+    stepIndexes gives each step's position in the campaign when the steps
+    are not contiguous (e.g. when re-scoring repaired steps).
+    """
+    if not steps:
+        return []
+
+    if stepIndexes is None:
+        stepIndexes = range(stepIndex, stepIndex + len(steps))
+    stepIndexes = list(stepIndexes)
+
+    # steps that fail the local checks go straight to repair
+    results = [None] * len(steps)
+    remote = []
+    for position, step in enumerate(steps):
+        screen = screen_step(step)
+        if screen_failed(screen):
+            results[position] = apply_local_checks(
+                step, {"totalScore": {"num": 0}, "highlights": {}}, screen
             )
-        elif body["campaignTone"] == "professional":
-            parts.append(
-                "- **Tone:** Maintain a professional and formal tone. Use clear and concise language, avoid contractions, and ensure messages convey a sense of expertise and credibility."
+        else:
+            remote.append(position)
+
+    # unchanged steps reuse their earlier content_suggestions result
+    misses = []
+    for position in remote:
+        suggestions = cached_score(steps[position], stepIndexes[position], teamId)
+        if suggestions is not None:
+            results[position] = suggestions
+        else:
+            misses.append(position)
+    if len(misses) < len(remote):
+        trace_increment("scoreCacheHits", len(remote) - len(misses))
+    remote = misses
+
+    remoteSteps = [steps[position] for position in remote]
+    remoteIndexes = [stepIndexes[position] for position in remote]
+
+    scored = None
+    if len(remoteSteps) > 1:
+        scored = validate_steps_batched(remoteSteps, teamId, remoteIndexes)
+
+    if scored is None and remoteSteps:
+        def validate(indexedStep):
+            index, step = indexedStep
+            return validate_content(step, index, teamId)
+
+        scored = list(validation_executor.map(validate, zip(remoteIndexes, remoteSteps)))
+
+    for position, suggestions in zip(remote, scored or []):
+        store_score(steps[position], stepIndexes[position], teamId, suggestions)
+        results[position] = suggestions
+
+    return results
+
+
+def process_content_validation(
+    content,
+    teamId,
+    stepIndex=0,
+    threshold=QUALITY_THRESHOLD,
+    maxRounds=REPAIR_MAX_ROUNDS,
+    tokenBudget=REPAIR_TOKEN_BUDGET,
+    scores=None,
+    report=None,
+):
+    steps = list(content) if isinstance(content, list) else [content]
+    # callers that already scored the steps can pass their suggestions in
+    scores = list(scores) if scores else validate_steps(steps, teamId, stepIndex)
+    failed = [
+        index
+        for index, suggestions in enumerate(scores)
+        if suggestions["totalScore"]["num"] < threshold
+    ]
+
+    with validation_stats_lock:
+        validation_stats["steps"] += len(steps)
+        validation_stats["failed"] += len(failed)
+
+    rounds = 0
+    tokensSpent = 0
+    # the first round uses the fast model; steps it leaves below threshold
+    # are escalated to the campaign model
+    escalated = False
+
+    # re-score repaired steps and only re-send the ones still below threshold
+    while failed and rounds < maxRounds and tokensSpent < tokenBudget:
+        rounds += 1
+        roundTokens = 0
+
+        # large campaigns are repaired in concurrent batches so a single
+        # response never has to carry dozens of templates
+        batches = [
+            failed[start : start + MODIFICATION_BATCH_SIZE]
+            for start in range(0, len(failed), MODIFICATION_BATCH_SIZE)
+        ]
+
+        def modify(batch):
+            batchUsage = {"tokens": 0}
+            with trace_stage("modifyFailedSteps", steps=len(batch)):
+                modified = modify_failed_steps(
+                    [(steps[index], scores[index]) for index in batch], batchUsage, escalated
+                )
+            return batch, modified, batchUsage["tokens"]
+
+        with TracedThreadPoolExecutor(max_workers=min(VALIDATION_MAX_WORKERS, len(batches))) as executor:
+            for batch, modified, tokens in executor.map(modify, batches):
+                for index, step in zip(batch, modified):
+                    steps[index] = step
+                roundTokens += tokens
+
+        tokensSpent += roundTokens
+
+        rescored = validate_steps(
+            [steps[index] for index in failed],
+            teamId,
+            stepIndexes=[stepIndex + index for index in failed],
+        )
+
+        scoreGained = 0
+        for index, suggestions in zip(failed, rescored):
+            scoreGained += suggestions["totalScore"]["num"] - scores[index]["totalScore"]["num"]
+            scores[index] = suggestions
+
+        failed = [
+            index for index in failed if scores[index]["totalScore"]["num"] < threshold
+        ]
+
+        print(
+            json.dumps(
+                {
+                    "repairRound": rounds,
+                    "model": route_llm("modification", escalated).model_name,
+                    "repairedSteps": len(rescored),
+                    "stillFailing": len(failed),
+                    "tokens": roundTokens,
+                    "scoreGained": scoreGained,
+                    "scorePerToken": scoreGained / roundTokens if roundTokens else None,
+                }
             )
-        elif body["campaignTone"] == "replicateTone":
-            campaign = get_campaign(body["selectedCampaign"])
-            content = " ".join(
-                html_to_text(template["content"])
-                for template in campaign["templates"].values()
+        )
+
+        if failed and not escalated:
+            escalated = True
+            trace_increment("escalations", len(failed))
+
+    if failed:
+        print(f"{len(failed)} step(s) still below threshold after {rounds} repair round(s).")
+
+    if report is not None:
+        with validation_stats_lock:
+            report["stillFailing"] = report.get("stillFailing", 0) + len(failed)
+
+    # on regeneration it's a single step
+    return steps if isinstance(content, list) else steps[0]
+
+
+class TemplateStreamParser:
+    """Incrementally extract complete objects from a streamed "templates" array."""
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = None
+        self.objectStart = None
+        self.depth = 0
+        self.inString = False
+        self.escaped = False
+        self.done = False
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        templates = []
+
+        if self.position is None:
+            match = re.search(r'"templates"\s*:\s*\[', self.buffer)
+            if not match:
+                return templates
+            self.position = match.end()
+
+        while not self.done and self.position < len(self.buffer):
+            char = self.buffer[self.position]
+
+            if self.inString:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.inString = False
+            elif char == '"':
+                self.inString = True
+            elif char == "{":
+                if self.depth == 0:
+                    self.objectStart = self.position
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    try:
+                        templates.append(
+                            json.loads(self.buffer[self.objectStart : self.position + 1])
+                        )
+                    except ValueError as e:
+                        print(f"Skipping malformed streamed template: {e}")
+            elif char == "]" and self.depth == 0:
+                self.done = True
+
+            self.position += 1
+
+        return templates
+
+
+def stream_campaign(messages, on_template, maxTokens=None):
+    """Stream a campaign completion, calling on_template(template, stepIndex)
+    as soon as each template closes. Returns the aggregated message."""
+    parser = TemplateStreamParser()
+    completion = None
+    stepIndex = 0
+
+    for chunk in llm.stream(messages, **({"max_tokens": maxTokens} if maxTokens else {})):
+        completion = chunk if completion is None else completion + chunk
+        for template in parser.feed(chunk.content):
+            on_template(template, stepIndex)
+            stepIndex += 1
+
+    return completion
+
+
+def parse_regenerated_template(content):
+    parsed = extract_json(content)
+    template = parsed.get("templates") if isinstance(parsed, dict) else None
+    if isinstance(template, list):
+        template = template[0] if template else None
+    if not isinstance(template, dict) or not isinstance(template.get("body"), str):
+        raise ValueError("response has no regenerated template")
+    return {"subject": template.get("subject") or "", "body": template["body"]}
+
+
+def regenerate_serially(messages, original_body):
+    client = route_llm("regeneration")
+    max_retries = 3
+    retries = 0
+
+    while retries < max_retries:
+        response = None
+        try:
+            # rotate so repeated regenerate clicks get a different candidate
+            response = response_cache.invoke(messages, rotate=True, client=client)
+            record_usage("regeneration", response)
+            with trace_stage("parse"):
+                template = parse_regenerated_template(response.content)
+            
+            if template["body"] != original_body:
+                return template
+                
+            response_cache.discard(messages, response.content, client)
+            retries += 1
+            trace_increment("retries")
+            print(f"Attempt {retries}: Generated content is the same as original. Retrying...")
+            
+        except CircuitOpenError as e:
+            print(f"{e}. Skipping retries.")
+            break
+        except Exception as e:
+            if response is not None:
+                response_cache.discard(messages, response.content, client)
+            retries += 1
+            trace_increment("retries")
+            print(f"Attempt {retries}: Error parsing response: {e}. Retrying...")
+
+    return None
+
+
+def regenerate_speculatively(messages, original_body, teamId, stepIndex, count, escalated=False):
+    """Request `count` candidates in parallel, drop unusable or unchanged ones
+    and score the rest concurrently. Returns (template, suggestions) for the
+    best candidate, or (None, None) if none is usable."""
+    client = route_llm("regeneration", escalated)
+
+    def request_candidate(_):
+        try:
+            with trace_stage("llm", speculative=True):
+                response = client.invoke(messages)
+            record_usage("regeneration", response)
+            return parse_regenerated_template(response.content)
+        except Exception as e:
+            print(f"Error generating candidate: {e}")
+            return None
+
+    with TracedThreadPoolExecutor(max_workers=count) as executor:
+        results = list(executor.map(request_candidate, range(count)))
+
+    candidates = []
+    seen = {original_body}
+    for candidate in results:
+        if candidate is not None and candidate["body"] not in seen:
+            seen.add(candidate["body"])
+            candidates.append(candidate)
+
+    if not candidates:
+        return None, None
+
+    scores = validate_steps(
+        candidates, teamId, stepIndexes=[stepIndex] * len(candidates)
+    )
+    best = max(range(len(candidates)), key=lambda i: scores[i]["totalScore"]["num"])
+    return candidates[best], scores[best]
+
+
+@catch_errors()
+@traced("chatbot_regenerate_response")
+def chatbot_regenerate_response(userId, teamId, body):
+    init_langchain()
+
+    user_prompt = f"""
+        **Subject:**
+        {body["subject"]}
+
+        **Body:**
+        {body["body"]}
+    """
+
+    messages = [*regeneration_prompt_prefix(), HumanMessage(content=user_prompt)]
+
+    _, step_str = body["messageId"].split("-step")
+    stepIndex = int(step_str) - 1
+
+    suggestions = None
+    if REGENERATE_CANDIDATES > 1:
+        template, suggestions = regenerate_speculatively(
+            messages, body["body"], teamId, stepIndex, REGENERATE_CANDIDATES
+        )
+
+        # quality gate: retry on the campaign model when the fast model's
+        # best candidate is unusable or still below threshold
+        if template is None or suggestions["totalScore"]["num"] < QUALITY_THRESHOLD:
+            trace_increment("escalations")
+            escalatedTemplate, escalatedSuggestions = regenerate_speculatively(
+                messages, body["body"], teamId, stepIndex, 1, escalated=True
             )
-            parts.append(
-                f'- **Tone:** Mimic the tone from the following text: "{content}"'
+            if escalatedTemplate is not None and (
+                template is None
+                or escalatedSuggestions["totalScore"]["num"] > suggestions["totalScore"]["num"]
+            ):
+                template, suggestions = escalatedTemplate, escalatedSuggestions
+    else:
+        template = regenerate_serially(messages, body["body"])
+
+    if template is None:
+        print("No usable regenerated content. Using the original content.")
+        # Fallback to original content if all retries failed
+        template = {"subject": body["subject"], "body": body["body"]}
+
+    data = {
+        "content": {
+            "templates": process_content_validation(
+                template,
+                teamId,
+                stepIndex,
+                scores=[suggestions] if suggestions else None,
             )
+        },
+        "id": body["messageId"],
+    }
+
+    with trace_stage("broadcast"):
+        broadcast_to_user(
+            userId, "aiRegenerateCampaignResponse", data, pathnames=["/campaigns"]
+        )
+
+    return data
+
+
+def campaign_locale(user):
+    timezone = user.get("timezone") or ""
+    return "British English" if timezone.startswith("Europe") else "American English"
+
+
+def example_group(teamId, body):
+    return f'{teamId}:{body["outreachType"]}:{sample_prompt_variant(body)}'
+
+
+def example_text(body):
+    """The request fields a campaign is matched on."""
+    fields = [
+        "positionDetails",
+        "jobLocation",
+        "whatWeOffer",
+        "buyerPainPoint",
+        "valueProposition",
+        "experience",
+        "skills",
+        "callToAction",
+        "additionalContext",
+        "campaignTone",
+    ]
+    parts = [str(body[field]) for field in fields if body.get(field)]
+    parts.extend(body.get("channels") or [])
+    return " ".join(parts)
+
+
+def few_shot_examples(teamId, body):
+    """Past campaigns closest to this request, as extra few-shot messages."""
+    if not FEW_SHOT_EXAMPLES or teamId is None:
+        return []
+
+    with trace_stage("fewShotRetrieval"):
+        examples = example_index.search(
+            example_group(teamId, body), example_text(body), FEW_SHOT_EXAMPLES, FEW_SHOT_TOKEN_BUDGET
+        )
+    trace_increment("fewShotExamples", len(examples))
+
+    messages = []
+    for example in examples:
+        messages.append(HumanMessage(content=example["userPrompt"]))
+        messages.append(AIMessage(content=example["assistant"]))
+    return messages
+
+
+def remember_campaign(teamId, body, langchain_messages, title, steps, report):
+    """Index a campaign whose steps all passed validation.
+
+    Agencies recruit for many clients under one team, so the hiring company
+    is stored as SWCompanyExample and substituted again on the next use.
+    """
+    if not FEW_SHOT_EXAMPLES or report.get("stillFailing") or not steps:
+        return
+    # only variants that substitute SWCompanyExample back can be masked
+    hiringCompanyName = company_name(body)
+    templates = [
+        {
+            key: value if key == "mailType" else mask_company(value, hiringCompanyName)
+            for key, value in step.items()
+        }
+        for step in steps
+    ]
+    example_index.add(
+        example_group(teamId, body),
+        example_text(body),
+        mask_company(langchain_messages[-1].content, hiringCompanyName),
+        json.dumps({"title": mask_company(title, hiringCompanyName), "templates": templates}),
+    )
+
+
+def build_campaign_messages(body, locale, campaign=None, teamId=None):
+    """Prompt messages for one campaign and the mailTypes of its randomized
+    step sequence."""
+    mailTypes = randomize_campaign_steps(body)
+    user_prompt = build_user_prompt(body, mailTypes, campaign) + campaign_language_prompt(locale)
+
+    # retrieved examples go after the static prefix so it stays cacheable
+    return [
+        *campaign_prompt_prefix(body["outreachType"], sample_prompt_variant(body)),
+        *few_shot_examples(teamId, body),
+        HumanMessage(content=user_prompt),
+    ], mailTypes
+
+
+def plan_output_budget(mailTypes, title=True):
+    """max_tokens for generating the given steps (and the title)."""
+    tokens = sum(STEP_OUTPUT_TOKENS.get(mailType, STEP_OUTPUT_TOKENS["email"]) for mailType in mailTypes)
+    if title:
+        tokens += CAMPAIGN_TITLE_TOKENS
+    return max(
+        OUTPUT_BUDGET_MIN,
+        min(MODEL_ROUTES["campaign"]["max_tokens"], int(tokens * OUTPUT_BUDGET_MARGIN)),
+    )
+
+
+def is_truncated(response):
+    metadata = getattr(response, "response_metadata", None) or {}
+    return metadata.get("finish_reason") == "length"
+
+
+def partial_campaign(content):
+    """(title or None, complete templates) from a possibly cut off response."""
+    match = CAMPAIGN_TITLE_PATTERN.search(content)
+    title = json.loads(match.group(1)) if match else None
+    return title, TemplateStreamParser().feed(content)
 
-        if "callToAction" in body:
-            parts.append(f'- **Call to action:** {body["callToAction"]}')
-        if "additionalContext" in body:
-            parts.append(f'- **Additional context:** {body["additionalContext"]}')
 
-        if "replicateUserStyle" in body:
-            parts.extend(
+def continuation_messages(messages, title, templates, mailTypes):
+    remaining = "\n".join(
+        f"{index + 1}. {mailType}"
+        for index, mailType in enumerate(mailTypes)
+        if index >= len(templates)
+    )
+    return [
+        *messages,
+        AIMessage(content=json.dumps({"title": title, "templates": templates})),
+        HumanMessage(
+            content="\n".join(
                 [
+                    "Your response was cut off. Continue the same campaign with the remaining steps,",
+                    "returning only their templates in the same JSON format.",
                     "",
-                    "## Writing Style",
-                    "",
-                    "Replicate the user's writing style from the following text snippets:",
+                    "## Campaign Step Sequence",
                     "",
-                    '- ""',
-                    '- ""',
-                    '- ""',
+                    remaining,
                 ]
             )
+        ),
+    ]
 
-        parts.extend(
-            ["", "## Campaign Step Sequence", "", randomize_campaign_steps(body)]
-        )
 
-        return "\n".join(parts)
+def continue_campaign(messages, mailTypes, content, route, on_template=None):
+    """Finish a campaign whose response hit max_tokens: keep every complete
+    template and request only the remaining steps. Continued templates are
+    passed to on_template(template, stepIndex) as they arrive.
+    Returns (title, records) like parse_campaign, skipping malformed
+    templates as the streamed path does."""
+    title, templates = partial_campaign(content)
+    rounds = 0
+
+    while len(templates) < len(mailTypes) and rounds < CONTINUATION_MAX_ROUNDS:
+        rounds += 1
+        trace_increment("continuations")
+        print(f"Campaign cut off after {len(templates)} of {len(mailTypes)} steps. Continuing...")
+
+        with trace_stage("llm", continuation=rounds):
+            response = llm.invoke(
+                continuation_messages(messages, title, templates, mailTypes),
+                max_tokens=plan_output_budget(mailTypes[len(templates) :], title=False),
+            )
+        record_usage(route, response)
+
+        _, continued = partial_campaign(response.content)
+        continued = continued[: len(mailTypes) - len(templates)]
+        if not continued:
+            break
+        if on_template is not None:
+            for offset, template in enumerate(continued):
+                on_template(template, len(templates) + offset)
+        templates.extend(continued)
+
+    records = []
+    for stepIndex, template in enumerate(templates):
+        try:
+            records.append(StepRecord.from_dict(template))
+        except ValueError as e:
+            print(f"Skipping malformed template {stepIndex}: {e}")
+
+    if not records:
+        raise ValueError("truncated response has no complete templates")
+    if len(records) < len(mailTypes):
+        print(f"Keeping {len(records)} of {len(mailTypes)} steps after {rounds} continuation(s).")
+
+    # fallback in case the output is missing title
+    return title or "AI Generated Campaign", records
+
+
+def broadcast_campaign(userId, body, title, steps):
+    title = substitute_company(title, company_name(body))
+    data = {"title": title, "content": steps, "id": body["messageId"]}
+
+    with trace_stage("broadcast"):
+        broadcast_to_user(userId, "aiCampaignResponse", data, pathnames=["/campaigns"])
+
+
+def idempotency_key(body):
+    payload = json.dumps(body, sort_keys=True, default=str)
+    return f'{body["messageId"]}:{hashlib.sha256(payload.encode("utf-8")).hexdigest()}'
+
+
+def idempotent(func):
+    """Run func(userId, teamId, body, ...) once per messageId and payload.
+
+    Duplicates of a request that is still in flight wait for it and raise
+    DuplicateInFlightError if it outlasts IDEMPOTENCY_WAIT_SECONDS; duplicates
+    of a completed one re-broadcast its (title, steps) result. A run that
+    fails or returns None releases its claim so a retry can run it again.
+    """
+
+    @wraps(func)
+    def wrapper(userId, teamId, body, *args, **kwargs):
+        key = idempotency_key(body)
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+        pollSeconds = IDEMPOTENCY_POLL_SECONDS
+
+        while True:
+            state, result = idempotency_store.claim(key, IDEMPOTENCY_LOCK_TTL)
+            if state == "claimed":
+                break
+
+            if state == "done":
+                trace_increment("duplicates")
+                print(f"Reusing the campaign already generated for {body['messageId']}.")
+                title, steps = result
+                broadcast_campaign(userId, body, title, steps)
+                return title, steps
+
+            if time.monotonic() >= deadline:
+                raise DuplicateInFlightError(f"{body['messageId']} is still being generated elsewhere")
+            time.sleep(pollSeconds)
+            pollSeconds = min(pollSeconds * 2, IDEMPOTENCY_POLL_MAX_SECONDS)
+
+        try:
+            result = func(userId, teamId, body, *args, **kwargs)
+        except BaseException:
+            idempotency_store.release(key)
+            raise
+
+        if result is None:
+            idempotency_store.release(key)
+        else:
+            idempotency_store.complete(key, list(result), IDEMPOTENCY_TTL)
+        return result
+
+    return wrapper
+
+
+# idempotent sits outside catch_errors so a DuplicateInFlightError reaches
+# lambda_handler (async invocations are retried) or the queue worker
+@traced("chatbot_response")
+@idempotent
+@catch_errors()
+def chatbot_response(userId, teamId, body):
+    if ASYNC_PIPELINE and not body.get("streamSteps"):
+        # sync shim so lambda_handler keeps its contract
+        return asyncio.run(chatbot_response_async(userId, teamId, body))
+
+    init_langchain()
+
+    with trace_stage("promptBuild"):
+        locale = campaign_locale(get_user(userId))
+        langchain_messages, mailTypes = build_campaign_messages(body, locale, teamId=teamId)
 
-    user_prompt = build_user_prompt(body)
+    if not body.get("streamSteps"):
+        return generate_campaign(userId, teamId, body, langchain_messages, mailTypes)
 
-    # Convert the old message format to LangChain format
-    old_messages = add_system_and_sample_prompt(body, systemPrompt)
-    old_messages.append({"role": "user", "content": user_prompt})
-    
-    # Convert to LangChain message format
-    langchain_messages = []
-    for msg in old_messages:
-        if msg["role"] == "system":
-            langchain_messages.append(SystemMessage(content=msg["content"] + "\n" + campaign_parser.get_format_instructions()))
-        elif msg["role"] == "user":
-            langchain_messages.append(HumanMessage(content=msg["content"]))
-        elif msg["role"] == "assistant":
-            langchain_messages.append(AIMessage(content=msg["content"]))
+    # broadcast each step as soon as it is parsed and validated
+    hiringCompanyName = company_name(body)
+    report = {}
 
+    def validate_and_broadcast(template, stepIndex):
+        try:
+            step = StepRecord.from_dict(template).to_dict(hiringCompanyName)
+        except ValueError as e:
+            print(f"Skipping malformed streamed template {stepIndex}: {e}")
+            return None
+        step = process_content_validation(step, teamId, stepIndex, report=report)
+
+        with trace_stage("broadcast", stepIndex=stepIndex):
+            broadcast_to_user(
+                userId,
+                "aiCampaignStepResponse",
+                {"step": step, "stepIndex": stepIndex, "id": body["messageId"]},
+                pathnames=["/campaigns"],
+            )
+        return step
+
+    futures = []
+    with TracedThreadPoolExecutor(max_workers=VALIDATION_MAX_WORKERS) as executor:
+
+        def submit(template, stepIndex):
+            futures.append(executor.submit(validate_and_broadcast, template, stepIndex))
+
+        try:
+            with trace_stage("llm", streamed=True):
+                completion = stream_campaign(
+                    langchain_messages, submit, plan_output_budget(mailTypes)
+                )
+            record_usage(body["outreachType"], completion)
+
+            if is_truncated(completion):
+                title, _ = continue_campaign(
+                    langchain_messages, mailTypes, completion.content, body["outreachType"], submit
+                )
+        except Exception as e:
+            print(f"Error in LLM call: {e}")
+            return None
+
+        steps = [step for step in (future.result() for future in futures) if step is not None]
+
+    if not is_truncated(completion):
+        try:
+            title, _ = parse_campaign(completion.content)
+        except ValueError:
+            # fallback in case the output is missing title
+            title = "AI Generated Campaign"
+
+    broadcast_campaign(userId, body, title, steps)
+    remember_campaign(teamId, body, langchain_messages, title, steps, report)
+
+    return title, steps
+
+
+def generate_campaign(userId, teamId, body, langchain_messages, mailTypes):
+    """Generate, validate and broadcast one campaign; returns (title, steps)."""
     try:
-        response = llm.invoke(langchain_messages)
-        output = campaign_parser.parse(response.content)
-        output = output.dict()  # Convert to dict for compatibility with existing code
+        with trace_stage("llm"):
+            response = llm.invoke(langchain_messages, max_tokens=plan_output_budget(mailTypes))
+        record_usage(body["outreachType"], response)
+        if is_truncated(response):
+            title, records = continue_campaign(
+                langchain_messages, mailTypes, response.content, body["outreachType"]
+            )
+        else:
+            with trace_stage("parse"):
+                title, records = parse_campaign(response.content)
 
     except Exception as e:
         print(f"Error in LLM call: {e}")
         return None
 
-    steps = process_content_validation(output["templates"], teamId)
+    hiringCompanyName = company_name(body)
+    steps = [record.to_dict(hiringCompanyName) for record in records]
 
-    # fallback in case the output is missing title
-    title = output.get("title", "AI Generated Campaign")
+    report = {}
+    with trace_stage("validation", steps=len(steps)):
+        steps = process_content_validation(steps, teamId, report=report)
 
-    def replace_sw_company(title, steps):
-        def replace_in_string(text):
-            if isinstance(text, str) and "SWCompanyExample" in text:
-                return text.replace("SWCompanyExample", body["hiringCompanyName"])
-            return text
+    broadcast_campaign(userId, body, title, steps)
+    remember_campaign(teamId, body, langchain_messages, title, steps, report)
 
-        title = replace_in_string(title)
+    return title, steps
 
-        steps = [dict(step) if isinstance(step, tuple) else step for step in steps]
 
-        for step in steps:
-            step["subject"] = replace_in_string(step.get("subject"))
-            for key, value in step.items():
-                step[key] = replace_in_string(value)
+@catch_errors()
+@traced("chatbot_bulk_response")
+def chatbot_bulk_response(userId, teamId, bodies, concurrency=BULK_MAX_CONCURRENCY):
+    """Generate many campaigns in one invocation.
 
-        return title, steps
+    The user lookup and prompt prefixes are shared, generations run
+    concurrently through the rate-limited client, validation goes through the shared validation pool and
+    each campaign is broadcast as soon as it completes.
+    """
+    init_langchain()
+
+    if not bodies:
+        return True
+
+    with trace_stage("promptBuild", campaigns=len(bodies)):
+        locale = campaign_locale(get_user(userId))
+        prompts = [build_campaign_messages(body, locale, teamId=teamId) for body in bodies]
+
+    failed = 0
+    with TracedThreadPoolExecutor(max_workers=min(concurrency, len(bodies))) as executor:
+        futures = [
+            executor.submit(
+                idempotent(generate_campaign),
+                userId,
+                teamId,
+                body,
+                langchain_messages,
+                mailTypes,
+            )
+            for body, (langchain_messages, mailTypes) in zip(bodies, prompts)
+        ]
+        for future in as_completed(futures):
+            try:
+                if future.result() is None:
+                    failed += 1
+            except Exception as e:
+                # one campaign failing validation must not abort the rest
+                print(f"Error generating bulk campaign: {e}")
+                failed += 1
+
+    if failed:
+        print(f"{failed} of {len(bodies)} bulk campaign(s) failed to generate.")
+        # falsy so a queued job is retried; finished campaigns are deduplicated
+        return None
+    return True
 
-    # in case the output includes SWCompanyExample (taken from samplePrompts)
-    if (
-        body["outreachType"] == "candidateSourcing"
-        and body["includeHiringCompanyName"] == "yes"
-    ):
-        title, steps = replace_sw_company(title, steps)
 
-    data = {"title": title, "content": steps, "id": body["messageId"]}
+async def chatbot_response_async(userId, teamId, body):
+    init_langchain()
+
+    loop = asyncio.get_running_loop()
+
+    # start the sw lookups first so they overlap with building the prompt prefix
+    userFuture = loop.run_in_executor(None, get_user, userId)
+    campaignFuture = (
+        loop.run_in_executor(None, get_campaign, body["selectedCampaign"])
+        if body["campaignTone"] == "replicateTone"
+        else None
+    )
+    campaign_prompt_prefix(body["outreachType"], sample_prompt_variant(body))
+
+    locale = campaign_locale(await userFuture)
+    campaign = await campaignFuture if campaignFuture else None
+    with trace_stage("promptBuild"):
+        langchain_messages, mailTypes = build_campaign_messages(body, locale, campaign, teamId)
+
+    try:
+        with trace_stage("llm"):
+            response = await llm.ainvoke(
+                langchain_messages, max_tokens=plan_output_budget(mailTypes)
+            )
+        record_usage(body["outreachType"], response)
+        if is_truncated(response):
+            title, records = await asyncio.to_thread(
+                continue_campaign, langchain_messages, mailTypes, response.content, body["outreachType"]
+            )
+        else:
+            with trace_stage("parse"):
+                title, records = parse_campaign(response.content)
+
+    except Exception as e:
+        print(f"Error in LLM call: {e}")
+        return None
+
+    hiringCompanyName = company_name(body)
+    steps = [record.to_dict(hiringCompanyName) for record in records]
+
+    # validation fans out over its own thread pool
+    report = {}
+    with trace_stage("validation", steps=len(steps)):
+        steps = await asyncio.to_thread(process_content_validation, steps, teamId, report=report)
+
+    await asyncio.to_thread(broadcast_campaign, userId, body, title, steps)
+    remember_campaign(teamId, body, langchain_messages, title, steps, report)
 
-    broadcast_to_user(userId, "aiCampaignResponse", data, pathnames=["/campaigns"])
+    return title, steps
 
 
 def create_modification_prompt(failedSteps):
-    userPrompt = ""
+    parts = []
     for step, suggestions in failedSteps:
         spamWords = suggestions["highlights"].get("spamWords", [])
         invalidCustomVars = suggestions["highlights"].get("invalidCustomVars", [])
-        userPrompt += f"""
+        parts.append(f"""
 
         - **Subject:**
-        {step.get("subject", "")}
+        {step.get("subject") or ""}
 
         - **Content:**
         {step["body"]}
@@ -796,20 +2615,289 @@ def create_modification_prompt(failedSteps):
         - **Invalid Custom Variables:**
         {", ".join(invalidCustomVars)}
 
-        """
-    return userPrompt
+        """)
+    return "".join(parts)
+
+
+class JobQueue(ABC):
+    """Work queue behind DISPATCH_MODE="queue".
+
+    get_batch claims up to `maxJobs` jobs as (jobId, payload) pairs, waiting
+    up to `wait` seconds for the first one. A claimed job is acked once it
+    has run or released to be retried, up to QUEUE_MAX_ATTEMPTS times.
+    """
+
+    @abstractmethod
+    def put(self, payload):
+        pass
+
+    @abstractmethod
+    def get_batch(self, maxJobs, wait=0):
+        pass
+
+    @abstractmethod
+    def ack(self, jobId):
+        pass
+
+    @abstractmethod
+    def release(self, jobId):
+        pass
+
+
+class MemoryJobQueue(JobQueue):
+    """In-process queue for local runs and benchmarks."""
+
+    def __init__(self, maxAttempts=QUEUE_MAX_ATTEMPTS):
+        self.maxAttempts = maxAttempts
+        self.pending = OrderedDict()
+        self.claimed = {}
+        self.attempts = {}
+        self.nextId = 0
+        self.condition = threading.Condition()
+
+    def put(self, payload):
+        with self.condition:
+            self.nextId += 1
+            self.pending[self.nextId] = payload
+            self.condition.notify()
+            return self.nextId
+
+    def get_batch(self, maxJobs, wait=0):
+        with self.condition:
+            if not self.pending and wait:
+                self.condition.wait(wait)
+
+            batch = []
+            while self.pending and len(batch) < maxJobs:
+                jobId, payload = self.pending.popitem(last=False)
+                self.claimed[jobId] = payload
+                self.attempts[jobId] = self.attempts.get(jobId, 0) + 1
+                batch.append((jobId, payload))
+            return batch
+
+    def ack(self, jobId):
+        with self.condition:
+            self.claimed.pop(jobId, None)
+            self.attempts.pop(jobId, None)
+
+    def release(self, jobId):
+        with self.condition:
+            payload = self.claimed.pop(jobId, None)
+            if payload is None:
+                return
+            if self.attempts[jobId] >= self.maxAttempts:
+                print(f"Dropping job {jobId} after {self.attempts.pop(jobId)} attempts.")
+                return
+            self.pending[jobId] = payload
+            self.condition.notify()
+
+    def __len__(self):
+        return len(self.pending) + len(self.claimed)
+
+
+class SQLiteJobQueue(JobQueue):
+    """Queue in a SQLite file so separate local processes can share it.
+
+    Claimed jobs that are neither acked nor released (e.g. the worker died)
+    become visible again after `visibilityTimeout` seconds; jobs that run
+    out of attempts stay in the table for inspection.
+    """
+
+    def __init__(self, path, visibilityTimeout=QUEUE_VISIBILITY_TIMEOUT, maxAttempts=QUEUE_MAX_ATTEMPTS):
+        self.visibilityTimeout = visibilityTimeout
+        self.maxAttempts = maxAttempts
+        self.lock = threading.Lock()
+        # autocommit; claims take an explicit write lock
+        self.connection = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "payload TEXT NOT NULL, "
+            "visibleAt REAL NOT NULL DEFAULT 0, "
+            "attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+
+    def put(self, payload):
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO jobs (payload) VALUES (?)", (json.dumps(payload),)
+            )
+        return cursor.lastrowid
+
+    def claim(self, maxJobs):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.connection.execute(
+                    "SELECT id, payload FROM jobs WHERE visibleAt <= ? AND attempts < ? "
+                    "ORDER BY id LIMIT ?",
+                    (now, self.maxAttempts, maxJobs),
+                ).fetchall()
+                self.connection.executemany(
+                    "UPDATE jobs SET visibleAt = ?, attempts = attempts + 1 WHERE id = ?",
+                    [(now + self.visibilityTimeout, jobId) for jobId, _ in rows],
+                )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return [(jobId, json.loads(payload)) for jobId, payload in rows]
+
+    def get_batch(self, maxJobs, wait=0):
+        deadline = time.monotonic() + wait
+        while True:
+            batch = self.claim(maxJobs)
+            remaining = deadline - time.monotonic()
+            if batch or remaining <= 0:
+                return batch
+            time.sleep(min(0.1, remaining))
+
+    def ack(self, jobId):
+        with self.lock:
+            self.connection.execute("DELETE FROM jobs WHERE id = ?", (jobId,))
+
+    def release(self, jobId):
+        with self.lock:
+            self.connection.execute("UPDATE jobs SET visibleAt = 0 WHERE id = ?", (jobId,))
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE attempts < ?", (self.maxAttempts,)
+            ).fetchone()[0]
+
+
+class SQSJobQueue(JobQueue):
+    """Amazon SQS. Visibility timeout and dead-lettering come from the
+    queue's own configuration; job ids are receipt handles."""
+
+    def __init__(self, queueUrl):
+        self.queueUrl = queueUrl
+        self.client = None
+
+    def sqs(self):
+        if self.client is None:
+            import boto3
+
+            self.client = boto3.client("sqs")
+        return self.client
+
+    def put(self, payload):
+        response = self.sqs().send_message(QueueUrl=self.queueUrl, MessageBody=json.dumps(payload))
+        return response["MessageId"]
+
+    def get_batch(self, maxJobs, wait=0):
+        response = self.sqs().receive_message(
+            QueueUrl=self.queueUrl,
+            MaxNumberOfMessages=max(1, min(10, maxJobs)),
+            WaitTimeSeconds=min(20, int(wait)),
+        )
+        return [
+            (message["ReceiptHandle"], json.loads(message["Body"]))
+            for message in response.get("Messages", [])
+        ]
+
+    def ack(self, jobId):
+        self.sqs().delete_message(QueueUrl=self.queueUrl, ReceiptHandle=jobId)
+
+    def release(self, jobId):
+        self.sqs().change_message_visibility(
+            QueueUrl=self.queueUrl, ReceiptHandle=jobId, VisibilityTimeout=0
+        )
+
+
+def create_job_queue():
+    backend = os.environ.get("LLM_QUEUE_BACKEND", "memory")
+    if DISPATCH_MODE == "queue" and backend == "memory":
+        # nothing outside this process could drain it, so requests would be lost
+        raise ValueError(
+            "LLM_DISPATCH=queue needs a shared LLM_QUEUE_BACKEND (sqs, or sqlite for local runs)"
+        )
+    if backend == "sqs":
+        return SQSJobQueue(os.environ["LLM_QUEUE_URL"])
+    if backend == "sqlite":
+        return SQLiteJobQueue(os.environ.get("LLM_QUEUE_PATH", "/tmp/llm-queue.sqlite3"))
+    return MemoryJobQueue()
+
+
+job_queue = create_job_queue()
+
+
+def run_job(job):
+    """Run a dispatched request (self-invocation event or queued payload).
+
+    Entry points catch their own errors, so a falsy result is how a failed
+    job is reported.
+    """
+    if job.get("regenerateSingle"):
+        return chatbot_regenerate_response(job["userId"], job["teamId"], job["body"])
+
+    if job.get("bulk"):
+        return chatbot_bulk_response(job["userId"], job["teamId"], job["body"]["campaigns"])
+
+    return chatbot_response(job["userId"], job["teamId"], job["body"])
+
+
+@traced("run_job_batch")
+def run_job_batch(batch, concurrency=QUEUE_MAX_CONCURRENCY):
+    """Run (jobId, payload) jobs, at most `concurrency` at a time.
+    Returns the ids of the jobs that raised or returned a falsy result."""
+    init_langchain()
+
+    failed = []
+    with TracedThreadPoolExecutor(max_workers=min(concurrency, len(batch))) as executor:
+        futures = {executor.submit(run_job, job): jobId for jobId, job in batch}
+        for future in as_completed(futures):
+            try:
+                succeeded = future.result()
+            except Exception as e:
+                print(f"Job {futures[future]} failed: {e}")
+                succeeded = False
+            if not succeeded:
+                failed.append(futures[future])
+
+    trace_increment("jobs", len(batch))
+    return failed
+
+
+def run_worker(queue=None, batchSize=QUEUE_BATCH_SIZE, concurrency=QUEUE_MAX_CONCURRENCY, wait=QUEUE_POLL_SECONDS, stopWhenIdle=False):
+    """Long-lived worker: drain `queue` in batches until it stays empty for
+    `wait` seconds (with stopWhenIdle) or forever. Returns the number of jobs run."""
+    queue = queue or job_queue
+    processed = 0
+
+    while True:
+        batch = queue.get_batch(batchSize, wait=wait)
+        if not batch:
+            if stopWhenIdle:
+                return processed
+            continue
+
+        failed = set(run_job_batch(batch, concurrency))
+        for jobId, _ in batch:
+            if jobId in failed:
+                queue.release(jobId)
+            else:
+                queue.ack(jobId)
+        processed += len(batch)
 
 
+@traced("lambda_handler")
 def lambda_handler(event, context):
     print("event =", event)
 
-    if event.get("regenerateSingle"):
-        return chatbot_regenerate_response(
-            event["userId"], event["teamId"], event["body"]
+    if "Records" in event:
+        # SQS event source mapping: each record is a queued job
+        failed = run_job_batch(
+            [(record["messageId"], json.loads(record["body"])) for record in event["Records"]]
         )
+        return {"batchItemFailures": [{"itemIdentifier": jobId} for jobId in failed]}
 
-    if event.get("async"):
-        return chatbot_response(event["userId"], event["teamId"], event["body"])
+    if event.get("regenerateSingle") or event.get("bulk") or event.get("async"):
+        return run_job(event)
 
     userId, teamId = process_authorizer(event)
 
@@ -821,8 +2909,14 @@ def lambda_handler(event, context):
         "teamId": teamId,
         "async": True,
         "regenerateSingle": body.get("regenerateSingle", False),
+        "bulk": "campaigns" in body,
     }
 
-    async_invoke(context.function_name, payload)
+    if DISPATCH_MODE == "queue":
+        with trace_stage("enqueue"):
+            job_queue.put(payload)
+    else:
+        with trace_stage("asyncInvoke"):
+            async_invoke(context.function_name, payload)
 
     return json_response("success")
\ No newline at end of file
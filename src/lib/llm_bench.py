@@ -0,0 +1,718 @@
+"""Offline benchmarks for llm.py.
+
+Swaps ChatOpenAI, sw.core, sw.sourcewhale and aws.async_invoke for local
+fakes with configurable latency, failure rate and canned responses, then
+reports throughput, p50/p99 latency and LLM calls per scenario:
+
+    python llm_bench.py --iterations 20 --llm-latency 0.5 --score-latency 0.1
+
+--import-check instead times `import llm` under -X importtime and exits
+non-zero when it exceeds --max-import-ms or loads LangChain:
+
+    python llm_bench.py --import-check --max-import-ms 250
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import types
+
+
+class BenchConfig:
+    llmLatency = 0.2
+    scoreLatency = 0.05
+    failureRate = 0.0
+    spamRate = 0.0
+    # "ok", "malformed" (first reply is not JSON) or "wrongCount"
+    responseMode = "ok"
+    batchScoring = False
+    # share of fast-model rewrites that come back spammy (escalation gate)
+    fastSpamRate = 0.0
+    # start-up cost of a Lambda invocation (invoke API + cold/warm start)
+    invokeOverhead = 0.1
+    # spam rate of campaigns prompted with retrieved examples (None: spamRate)
+    exampleSpamRate = None
+
+
+config = BenchConfig()
+counters = {}
+countersLock = threading.Lock()
+
+
+def count(name, amount=1):
+    with countersLock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+# fakes
+
+
+class FakeMessage:
+    def __init__(self, content, inputTokens=0, outputTokens=0, finishReason="stop"):
+        self.content = content
+        self.usage_metadata = {
+            "input_tokens": inputTokens,
+            "output_tokens": outputTokens,
+            "total_tokens": inputTokens + outputTokens,
+            "input_token_details": {"cache_read": 0},
+        }
+        self.response_metadata = {"finish_reason": finishReason}
+
+    def __add__(self, other):
+        return FakeMessage(
+            self.content + other.content,
+            self.usage_metadata["input_tokens"] + other.usage_metadata["input_tokens"],
+            self.usage_metadata["output_tokens"] + other.usage_metadata["output_tokens"],
+            other.response_metadata["finish_reason"],
+        )
+
+
+def fake_step_body(mailType, index, spamRate):
+    if random.random() < spamRate:
+        return "Hi {{firstName}},\n\nI hope you are well. Regards, {[senderFirstName]}"
+    if mailType == "phoneCall":
+        return "Call candidate"
+    return f"Hi {{{{firstName}}}},\n\nStep {index + 1} about {{{{company}}}}.\n\n{{[senderFirstName]}}"
+
+
+def fake_rewrite(model, text):
+    if model != "gpt-4o" and random.random() < config.fastSpamRate:
+        return "I hope you are well. " + text
+    return text
+
+
+def fake_completion(messages, attempt, model="gpt-4o"):
+    prompt = messages[-1].content
+
+    if config.responseMode == "malformed" and attempt == 0:
+        return '{"title": "Truncated", "templates": [{"subject": "'
+
+    if "## Campaign Step Sequence" in prompt:
+        mailTypes = re.findall(r"^\d+\. (\w+)$", prompt, re.MULTILINE)
+        # system prompt, static sample pair and request; more means retrieved examples
+        spamRate = config.spamRate
+        if len(messages) > 4 and config.exampleSpamRate is not None:
+            spamRate = config.exampleSpamRate
+        templates = []
+        for index, mailType in enumerate(mailTypes):
+            template = {"body": fake_step_body(mailType, index, spamRate), "mailType": mailType}
+            # like the system prompt's example, steps without a subject omit it
+            if mailType not in ("phoneCall", "linkedinConnectionRequest"):
+                template = {"subject": f"Subject {index + 1}", **template}
+            templates.append(template)
+        return json.dumps({"title": "Bench Campaign", "templates": templates})
+
+    requested = prompt.count("- **Content:**")
+    if requested:
+        if config.responseMode == "wrongCount" and attempt == 0:
+            requested -= 1
+        templates = [
+            {"subject": f"Fixed {index + 1}", "body": fake_rewrite(model, f"Rewritten step {index + 1} {{[senderFirstName]}}")}
+            for index in range(requested)
+        ]
+        return json.dumps({"templates": templates})
+
+    # regeneration
+    return json.dumps(
+        {"templates": {"subject": "Regenerated", "body": fake_rewrite(model, f"Reworded {random.random()}")}}
+    )
+
+
+class FakeChatOpenAI:
+    instances = 0
+
+    def __init__(self, **kwargs):
+        FakeChatOpenAI.instances += 1
+        self.model_name = kwargs.get("model")
+        self.temperature = kwargs.get("temperature")
+        self.max_tokens = kwargs.get("max_tokens")
+        self.attempts = {}
+
+    def complete(self, messages, maxTokens=None):
+        count("llmCalls")
+        time.sleep(config.llmLatency)
+        if random.random() < config.failureRate:
+            raise RuntimeError("fake provider error")
+
+        key = messages[-1].content
+        attempt = self.attempts.get(key, 0)
+        self.attempts[key] = attempt + 1
+
+        inputTokens = sum(len(message.content) for message in messages) // 4
+        content = fake_completion(messages, attempt, self.model_name)
+        # ~4 characters per token; cut off like the provider at max_tokens
+        maxTokens = maxTokens or self.max_tokens
+        if maxTokens and len(content) > maxTokens * 4:
+            return FakeMessage(content[: maxTokens * 4], inputTokens, maxTokens, "length")
+        return FakeMessage(content, inputTokens, len(content) // 4)
+
+    def invoke(self, messages, **kwargs):
+        return self.complete(messages, kwargs.get("max_tokens"))
+
+    async def ainvoke(self, messages, **kwargs):
+        import asyncio
+
+        return await asyncio.to_thread(self.complete, messages, kwargs.get("max_tokens"))
+
+    def stream(self, messages, **kwargs):
+        message = self.complete(messages, kwargs.get("max_tokens"))
+        for start in range(0, len(message.content), 40):
+            yield FakeMessage(message.content[start : start + 40])
+        yield FakeMessage(
+            "",
+            message.usage_metadata["input_tokens"],
+            message.usage_metadata["output_tokens"],
+            message.response_metadata["finish_reason"],
+        )
+
+
+def fake_content_suggestions(body, teamId):
+    count("contentSuggestionsCalls")
+    time.sleep(config.scoreLatency)
+    return {"totalScore": {"num": 85}, "highlights": {"spamWords": []}}
+
+
+def fake_content_suggestions_batch(bodies, teamId):
+    count("contentSuggestionsCalls")
+    time.sleep(config.scoreLatency)
+    return [{"totalScore": {"num": 85}, "highlights": {"spamWords": []}} for _ in bodies]
+
+
+class FakeLambda:
+    """async_invoke that runs each payload as its own invocation: a new
+    thread that pays config.invokeOverhead before calling lambda_handler."""
+
+    handler = None
+    threads = []
+
+    @classmethod
+    def async_invoke(cls, functionName, payload):
+        count("asyncInvokes")
+        if cls.handler is None:
+            return
+        payload = json.loads(json.dumps(payload))
+        thread = threading.Thread(target=cls.run, args=(payload,))
+        thread.start()
+        cls.threads.append(thread)
+
+    @classmethod
+    def run(cls, payload):
+        time.sleep(config.invokeOverhead)
+        cls.handler(payload, FakeContext())
+
+    @classmethod
+    def join(cls):
+        while cls.threads:
+            cls.threads.pop().join()
+
+
+def fake_catch_errors():
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                count("errors")
+                print(f"bench: {func.__name__} raised {e!r}", file=sys.stderr)
+
+        return wrapper
+
+    return decorator
+
+
+def install_fakes():
+    def module(name, **attributes):
+        fake = types.ModuleType(name)
+        fake.__dict__.update(attributes)
+        sys.modules[name] = fake
+        return fake
+
+    module("aws", async_invoke=FakeLambda.async_invoke)
+    module("sw")
+    module(
+        "sw.core",
+        broadcast_to_user=lambda *args, **kwargs: count("broadcasts"),
+        get_campaign=lambda campaignId: {
+            "templates": {str(i): {"content": f"<p>Sample tone text {i}</p>"} for i in range(5)}
+        },
+        get_user=lambda userId: {"timezone": "Europe/London"},
+        html_to_text=lambda text: re.sub(r"<[^>]+>", "", text),
+        json_response=lambda *args, **kwargs: None,
+        process_authorizer=lambda event: ("bench-user", "bench-team"),
+    )
+    module("sw.errors", catch_errors=fake_catch_errors)
+
+    sourcewhale = {"content_suggestions": fake_content_suggestions}
+    if config.batchScoring:
+        sourcewhale["content_suggestions_batch"] = fake_content_suggestions_batch
+    module("sw.sourcewhale", **sourcewhale)
+
+    module("langchain_openai", ChatOpenAI=FakeChatOpenAI)
+
+    try:
+        import langchain_core.messages  # noqa: F401
+        import langchain_core.output_parsers  # noqa: F401
+        import langchain_core.pydantic_v1  # noqa: F401
+    except ImportError:
+        install_langchain_core_fallback(module)
+
+
+def install_langchain_core_fallback(module):
+    """Minimal langchain_core stand-ins so the harness runs without LangChain."""
+
+    class BaseMessage:
+        type = None
+
+        def __init__(self, content):
+            self.content = content
+
+    class JsonOutputParser:
+        def __init__(self, pydantic_object=None):
+            pass
+
+        def get_format_instructions(self):
+            return "Return JSON."
+
+        def parse(self, text):
+            text = text.strip()
+            if text.startswith("```"):
+                text = text.strip("`").split("\n", 1)[-1]
+            return json.loads(text)
+
+    module("langchain_core")
+    module(
+        "langchain_core.messages",
+        SystemMessage=type("SystemMessage", (BaseMessage,), {"type": "system"}),
+        HumanMessage=type("HumanMessage", (BaseMessage,), {"type": "human"}),
+        AIMessage=type("AIMessage", (BaseMessage,), {"type": "ai"}),
+    )
+    module("langchain_core.output_parsers", JsonOutputParser=JsonOutputParser)
+    module(
+        "langchain_core.pydantic_v1",
+        BaseModel=object,
+        Field=lambda **kwargs: None,
+    )
+
+
+# scenarios
+
+
+def campaign_body(index, numSteps=8):
+    return {
+        "outreachType": "candidateSourcing",
+        "includeHiringCompanyName": "yes",
+        "isInHouse": False,
+        "hiringCompanyName": "Bench Corp",
+        "positionDetails": "Senior Platform Engineer",
+        "jobLocation": "Remote",
+        "campaignTone": "casual",
+        "channels": ["email", "phoneCall", "linkedinConnectionRequest", "sms"],
+        "selectedNumOfSteps": str(numSteps),
+        "messageId": f"bench-{index}",
+    }
+
+
+def regenerate_body(index):
+    return {
+        "subject": "Platform role",
+        "body": "Hi {{firstName}}, are you open to a chat?",
+        "messageId": f"bench-{index}-step2",
+    }
+
+
+class FakeContext:
+    function_name = "bench-llm"
+
+
+DISPATCH_BURST = 20
+
+
+def dispatch_self_invoke(llm, index):
+    FakeLambda.handler = llm.lambda_handler
+    try:
+        for n in range(DISPATCH_BURST):
+            llm.lambda_handler({"body": json.dumps(campaign_body(f"{index}-{n}"))}, FakeContext())
+        FakeLambda.join()
+    finally:
+        FakeLambda.handler = None
+
+
+def dispatch_queue(llm, index):
+    llm.DISPATCH_MODE = "queue"
+    llm.job_queue = llm.MemoryJobQueue()
+    try:
+        for n in range(DISPATCH_BURST):
+            llm.lambda_handler({"body": json.dumps(campaign_body(f"{index}-{n}"))}, FakeContext())
+        # one worker invocation drains the whole burst
+        count("asyncInvokes")
+        time.sleep(config.invokeOverhead)
+        llm.run_worker(wait=0, stopWhenIdle=True)
+    finally:
+        llm.DISPATCH_MODE = "invoke"
+
+
+def truncated_campaign(llm, index, streamed=False):
+    """A 20-step campaign whose planned budget is too small for the output."""
+    stepTokens = llm.STEP_OUTPUT_TOKENS
+    llm.STEP_OUTPUT_TOKENS = {mailType: 5 for mailType in stepTokens}
+    try:
+        body = {**campaign_body(f"{index}-cut", 20), "streamSteps": streamed}
+        result = llm.chatbot_response("u", "t", body)
+        if streamed:
+            # broadcast per step; the final broadcast is the last one
+            return
+        if result is None or len(result[1]) != 20:
+            count("errors")
+    finally:
+        llm.STEP_OUTPUT_TOKENS = stepTokens
+
+
+def campaign_without_retrieval(llm, index):
+    examples = llm.FEW_SHOT_EXAMPLES
+    llm.FEW_SHOT_EXAMPLES = 0
+    try:
+        llm.chatbot_response("u", "t", campaign_body(index))
+    finally:
+        llm.FEW_SHOT_EXAMPLES = examples
+
+
+def campaign_uncached_scores(llm, index, sequential=False):
+    """A campaign whose steps all miss the score cache; sequential scores them
+    one content_suggestions call at a time, the baseline for concurrency."""
+    llm.score_cache = llm.MemoryCacheBackend(maxEntries=4096)
+    if not sequential:
+        llm.chatbot_response("u", "t", campaign_body(f"{index}-score"))
+        return
+
+    executor = llm.validation_executor
+    llm.validation_executor = llm.TracedThreadPoolExecutor(max_workers=1)
+    try:
+        llm.chatbot_response("u", "t", campaign_body(f"{index}-score"))
+    finally:
+        llm.validation_executor.shutdown()
+        llm.validation_executor = executor
+
+
+def duplicate_campaigns(llm, index, copies=3):
+    """A double-clicked generate plus a retried invocation of the same request."""
+    body = campaign_body(f"{index}-dup")
+    threads = [
+        threading.Thread(target=llm.chatbot_response, args=("u", "t", body))
+        for _ in range(copies)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    llm.chatbot_response("u", "t", body)
+
+
+def scenario_runs(llm):
+    return {
+        "lambda-front-door": lambda i: llm.lambda_handler(
+            {"body": json.dumps(campaign_body(i))}, FakeContext()
+        ),
+        "campaign": lambda i: llm.chatbot_response("u", "t", campaign_body(i)),
+        "campaign-no-retrieval": lambda i: campaign_without_retrieval(llm, i),
+        "campaign-streamed": lambda i: llm.chatbot_response(
+            "u", "t", {**campaign_body(i), "streamSteps": True}
+        ),
+        "campaign-async": lambda i: llm.asyncio.run(
+            llm.chatbot_response_async("u", "t", campaign_body(i))
+        ),
+        "campaign-50-steps": lambda i: llm.chatbot_response("u", "t", campaign_body(i, 50)),
+        "campaign-scores-concurrent": lambda i: campaign_uncached_scores(llm, i),
+        "campaign-scores-sequential": lambda i: campaign_uncached_scores(llm, i, sequential=True),
+        "regenerate": lambda i: llm.chatbot_regenerate_response("u", "t", regenerate_body(i)),
+        "bulk-10-campaigns": lambda i: llm.chatbot_bulk_response(
+            "u", "t", [campaign_body(f"{i}-{n}") for n in range(10)]
+        ),
+        "campaign-duplicates": lambda i: duplicate_campaigns(llm, i),
+        "campaign-truncated": lambda i: truncated_campaign(llm, i),
+        "campaign-truncated-streamed": lambda i: truncated_campaign(llm, i, streamed=True),
+        f"dispatch-{DISPATCH_BURST}-self-invoke": lambda i: dispatch_self_invoke(llm, i),
+        f"dispatch-{DISPATCH_BURST}-queue": lambda i: dispatch_queue(llm, i),
+    }
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def reset_rate_limits(llm):
+    """Refill every token bucket and close the breakers, so one scenario's
+    throttling doesn't carry over into the next."""
+    for client in llm.route_llms.values():
+        for bucket in (client.requests, client.tokens):
+            with bucket.lock:
+                bucket.tokens = bucket.capacity
+                bucket.updated = time.monotonic()
+        with client.lock:
+            client.failures = 0
+            client.openUntil = 0
+            client.pausedUntil = 0
+
+
+def run_scenario(llm, name, run, iterations):
+    counters.clear()
+    llm.route_metrics.clear()
+    # scenarios reuse message ids; only dedupe within a scenario
+    llm.idempotency_store = llm.MemoryIdempotencyBackend()
+    llm.example_index = llm.CampaignExampleIndex()
+    llm.validation_stats.update(steps=0, failed=0)
+    reset_rate_limits(llm)
+    constructedBefore = FakeChatOpenAI.instances
+    latencies = []
+
+    started = time.perf_counter()
+    for index in range(iterations):
+        runStarted = time.perf_counter()
+        run(index)
+        latencies.append((time.perf_counter() - runStarted) * 1000)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "scenario": name,
+        "iterations": iterations,
+        "throughput": iterations / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "llmCallsPerRun": counters.get("llmCalls", 0) / iterations,
+        "scoringCallsPerRun": counters.get("contentSuggestionsCalls", 0) / iterations,
+        "invocationsPerRun": counters.get("asyncInvokes", 0) / iterations,
+        "validationFailureRate": llm.validation_stats["failed"] / max(1, llm.validation_stats["steps"]),
+        "errors": counters.get("errors", 0),
+        "llmConstructed": FakeChatOpenAI.instances > constructedBefore,
+        "costPerRun": sum(route["cost"] for route in llm.route_metrics.values()) / iterations,
+        "routes": {
+            route: {
+                "model": stats["model"],
+                "calls": stats["calls"],
+                "avgMs": stats["seconds"] / stats["calls"] * 1000,
+                "cost": stats["cost"],
+            }
+            for route, stats in llm.route_metrics.items()
+        },
+    }
+
+
+def print_report(results):
+    header = f"{'scenario':<28}{'runs/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'llm/run':>9}{'score/run':>11}{'inv/run':>9}{'fail%':>7}{'$/run':>10}{'errors':>8}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result['scenario']:<28}{result['throughput']:>9.2f}{result['p50']:>10.1f}"
+            f"{result['p99']:>10.1f}{result['llmCallsPerRun']:>9.2f}"
+            f"{result['scoringCallsPerRun']:>11.2f}{result['invocationsPerRun']:>9.2f}"
+            f"{result['validationFailureRate'] * 100:>7.1f}"
+            f"{result['costPerRun']:>10.5f}{result['errors']:>8}"
+        )
+        for route, stats in result["routes"].items():
+            print(
+                f"  {route:<26}{stats['model']:<14}{stats['calls']:>6} calls"
+                f"{stats['avgMs']:>10.1f} ms/call  ${stats['cost']:.5f}"
+            )
+
+
+def sample_payloads(llm):
+    """The module's few-shot assistant payloads as a model would return them."""
+    payloads = []
+    for samples in llm.SAMPLE_PROMPTS.values():
+        for key, value in samples.items():
+            if key.startswith("assistant"):
+                payload = value.replace("{{", "{").replace("}}", "}")
+                # the {firstName} style custom vars are doubled in the real output
+                payload = re.sub(r"(?<!\{)\{(\w+)\}(?!\})", r"{{\1}}", payload)
+                payloads.append(payload)
+    return payloads
+
+
+def legacy_parse(llm, content, hiringCompanyName):
+    """The JsonOutputParser + copy-and-replace path parse_campaign replaced."""
+    output = llm.campaign_parser.parse(content)
+    title = output.get("title", "AI Generated Campaign")
+    steps = [dict(step) for step in output["templates"]]
+    title = title.replace("SWCompanyExample", hiringCompanyName)
+    for step in steps:
+        step["subject"] = step.get("subject")
+        for key, value in step.items():
+            if isinstance(value, str) and "SWCompanyExample" in value:
+                step[key] = value.replace("SWCompanyExample", hiringCompanyName)
+    return title, steps
+
+
+def lean_parse(llm, content, hiringCompanyName):
+    title, records = llm.parse_campaign(content)
+    title = llm.substitute_company(title, hiringCompanyName)
+    return title, [record.to_dict(hiringCompanyName) for record in records]
+
+
+def run_parsers(llm, iterations):
+    llm.init_langchain()
+    payloads = sample_payloads(llm)
+    wrapped = ["```json\n" + payload + "\n```\nLet me know if you need changes." for payload in payloads]
+
+    results = []
+    for name, parse, inputs in (
+        ("JsonOutputParser", legacy_parse, payloads),
+        ("parse_campaign", lean_parse, payloads),
+        ("parse_campaign (fenced)", lean_parse, wrapped),
+    ):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            for content in inputs:
+                parse(llm, content, "Bench Corp")
+        elapsed = time.perf_counter() - started
+        results.append(
+            {"parser": name, "payloads": len(inputs), "usPerParse": elapsed / (iterations * len(inputs)) * 1e6}
+        )
+
+    expected = [lean_parse(llm, content, "Bench Corp") for content in payloads]
+    results.append({"parser": "outputs match", "match": expected == [legacy_parse(llm, c, "Bench Corp") for c in payloads]})
+    return results
+
+
+# modules the Lambda front door must not load when llm is imported
+HEAVY_IMPORTS = ("langchain_core", "langchain_openai", "openai", "pydantic", "requests")
+
+IMPORT_CHECK_SCRIPT = """
+import sys
+import llm_bench
+llm_bench.install_fakes()
+for name in list(sys.modules):
+    if name.split(".")[0] in llm_bench.HEAVY_IMPORTS:
+        del sys.modules[name]
+import llm
+"""
+
+
+def run_import_check():
+    """Import llm in a fresh interpreter under -X importtime and return its
+    cumulative import time plus any heavy modules it pulled in.
+
+    The fakes stand in for aws and sw; LangChain is dropped from sys.modules
+    again so a top-level LangChain import shows up (or fails) here."""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_CHECK_SCRIPT],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    if process.returncode != 0:
+        return {"importMs": None, "heavyImports": [], "error": process.stderr.strip().splitlines()[-1]}
+
+    # "import time: self [us] | cumulative | name", children before their parent
+    entries = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        entries.append((int(cumulative), len(name) - len(name.lstrip()), name.strip()))
+
+    index = next(i for i, entry in enumerate(entries) if entry[2] == "llm")
+    cumulative, depth, _ = entries[index]
+    heavyImports = []
+    for _, childDepth, name in reversed(entries[:index]):
+        if childDepth <= depth:
+            break
+        if name.split(".")[0] in HEAVY_IMPORTS:
+            heavyImports.append(name)
+    return {"importMs": cumulative / 1000, "heavyImports": sorted(heavyImports), "error": None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--llm-latency", type=float, default=config.llmLatency)
+    parser.add_argument("--score-latency", type=float, default=config.scoreLatency)
+    parser.add_argument("--failure-rate", type=float, default=config.failureRate)
+    parser.add_argument("--spam-rate", type=float, default=config.spamRate)
+    parser.add_argument("--response-mode", choices=["ok", "malformed", "wrongCount"], default="ok")
+    parser.add_argument("--batch-scoring", action="store_true")
+    parser.add_argument("--fast-spam-rate", type=float, default=config.fastSpamRate)
+    parser.add_argument("--invoke-overhead", type=float, default=config.invokeOverhead)
+    parser.add_argument("--example-spam-rate", type=float, default=config.exampleSpamRate)
+    parser.add_argument("--scenario", action="append", help="run only these scenarios")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--parsers", action="store_true", help="benchmark response parsing only")
+    parser.add_argument("--import-check", action="store_true", help="check the cost of importing llm only")
+    parser.add_argument("--max-import-ms", type=float, default=250.0)
+    args = parser.parse_args(argv)
+
+    config.llmLatency = args.llm_latency
+    config.scoreLatency = args.score_latency
+    config.failureRate = args.failure_rate
+    config.spamRate = args.spam_rate
+    config.responseMode = args.response_mode
+    config.batchScoring = args.batch_scoring
+    config.fastSpamRate = args.fast_spam_rate
+    config.invokeOverhead = args.invoke_overhead
+    config.exampleSpamRate = args.example_spam_rate
+    random.seed(args.seed)
+
+    if args.import_check:
+        result = run_import_check()
+        result["maxImportMs"] = args.max_import_ms
+        if args.json:
+            print(json.dumps(result, indent=2))
+        elif result["error"]:
+            print(f"import llm failed: {result['error']}")
+        else:
+            print(f"import llm: {result['importMs']:.1f} ms (max {args.max_import_ms:.0f} ms)")
+            for name in result["heavyImports"]:
+                print(f"  loaded {name}")
+        if result["error"] or result["heavyImports"] or result["importMs"] > args.max_import_ms:
+            print("import llm regressed", file=sys.stderr)
+            return 1
+        return 0
+
+    install_fakes()
+
+    importStarted = time.perf_counter()
+    import llm
+
+    importMs = (time.perf_counter() - importStarted) * 1000
+
+    # responses are random per run; keep the response cache out of the numbers
+    llm.response_cache = llm.ResponseCache(llm.MemoryCacheBackend(), ttl=0)
+
+    if args.parsers:
+        results = run_parsers(llm, args.iterations)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            for result in results:
+                if "usPerParse" in result:
+                    print(f"{result['parser']:<28}{result['usPerParse']:>10.1f} us/parse")
+                else:
+                    print(f"{result['parser']:<28}{result['match']!s:>10}")
+        return 0
+
+    runs = scenario_runs(llm)
+    names = args.scenario or list(runs)
+    results = [run_scenario(llm, name, runs[name], args.iterations) for name in names]
+
+    if args.json:
+        print(json.dumps({"importMs": importMs, "results": results}, indent=2))
+    else:
+        print(f"import llm: {importMs:.1f} ms")
+        print_report(results)
+
+    frontDoor = next((r for r in results if r["scenario"] == "lambda-front-door"), None)
+    if frontDoor and frontDoor["llmConstructed"]:
+        print("lambda_handler front door constructed ChatOpenAI", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())